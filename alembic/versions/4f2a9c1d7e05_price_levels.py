@@ -0,0 +1,42 @@
+"""price levels table
+
+Revision ID: 4f2a9c1d7e05
+Revises: 838a4f335e2d
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '4f2a9c1d7e05'
+down_revision: Union[str, None] = '838a4f335e2d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'price_levels',
+        sa.Column('ticker', sa.String(length=10), sa.ForeignKey('instruments.ticker', ondelete='CASCADE'), nullable=False),
+        sa.Column('direction', postgresql.ENUM('BUY', 'SELL', name='order_direction_enum', create_type=False), nullable=False),
+        sa.Column('price', sa.Integer(), nullable=False),
+        sa.Column('total_qty', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('order_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint('ticker', 'direction', 'price'),
+    )
+    # заполняем по уже открытым лимитным ордерам
+    op.execute("""
+        INSERT INTO price_levels (ticker, direction, price, total_qty, order_count)
+        SELECT instrument_ticker, direction, price, SUM(qty - COALESCE(filled, 0)), COUNT(*)
+        FROM orders
+        WHERE status IN ('NEW', 'PARTIALLY_EXECUTED') AND type = 'LIMIT'
+        GROUP BY instrument_ticker, direction, price
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('price_levels')
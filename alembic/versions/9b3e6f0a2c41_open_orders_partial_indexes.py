@@ -0,0 +1,49 @@
+"""open orders partial covering index
+
+Revision ID: 9b3e6f0a2c41
+Revises: 4f2a9c1d7e05
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b3e6f0a2c41'
+down_revision: Union[str, None] = '4f2a9c1d7e05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+OPEN_LIMIT_ORDERS = sa.text("status IN ('NEW', 'PARTIALLY_EXECUTED') AND type = 'LIMIT'")
+
+
+def upgrade() -> None:
+    # CONCURRENTLY нельзя внутри транзакции, а orders на проде не блокируем
+    with op.get_context().autocommit_block():
+        # Встречные ордера для матчинга: равенство по тикеру и стороне, порядок (price, timestamp, id).
+        # qty, filled, user_id в INCLUDE — чтение порции идёт index-only.
+        op.create_index(
+            'idx_orders_open_book',
+            'orders',
+            ['instrument_ticker', 'direction', 'price', 'timestamp', 'id'],
+            postgresql_where=OPEN_LIMIT_ORDERS,
+            postgresql_include=['qty', 'filled', 'user_id'],
+            postgresql_concurrently=True,
+        )
+        # Загрузка стаканов на старте идёт по времени
+        op.create_index(
+            'idx_orders_open_by_time',
+            'orders',
+            ['timestamp'],
+            postgresql_where=OPEN_LIMIT_ORDERS,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('idx_orders_open_by_time', table_name='orders', postgresql_concurrently=True)
+        op.drop_index('idx_orders_open_book', table_name='orders', postgresql_concurrently=True)
@@ -0,0 +1,52 @@
+"""balance ledger
+
+Revision ID: a7c2d9e4b318
+Revises: f3a86c2e1d47
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c2d9e4b318'
+down_revision: Union[str, None] = 'f3a86c2e1d47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'balance_ledger',
+        sa.Column('id', sa.BigInteger(), primary_key=True, autoincrement=True),
+        sa.Column('user_id', postgresql.UUID(as_uuid=True), sa.ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('instrument_ticker', sa.String(length=10), sa.ForeignKey('instruments.ticker', ondelete='CASCADE'), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('locked', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('timestamp', sa.TIMESTAMP(timezone=True), nullable=False, server_default=sa.text('now()')),
+    )
+    op.create_index(
+        'idx_balance_ledger_key',
+        'balance_ledger',
+        ['user_id', 'instrument_ticker'],
+        postgresql_include=['amount', 'locked'],
+    )
+
+
+def downgrade() -> None:
+    # несвёрнутые изменения сначала переносятся в balances
+    op.execute("""
+        INSERT INTO balances (user_id, instrument_ticker, amount, locked)
+        SELECT user_id, instrument_ticker, sum(amount), sum(locked)
+        FROM balance_ledger
+        GROUP BY user_id, instrument_ticker
+        ON CONFLICT (user_id, instrument_ticker) DO UPDATE
+        SET amount = balances.amount + excluded.amount,
+            locked = balances.locked + excluded.locked
+    """)
+    op.drop_index('idx_balance_ledger_key', table_name='balance_ledger')
+    op.drop_table('balance_ledger')
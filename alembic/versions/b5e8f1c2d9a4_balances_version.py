@@ -0,0 +1,27 @@
+"""balances version column
+
+Revision ID: b5e8f1c2d9a4
+Revises: a7c2d9e4b318
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5e8f1c2d9a4'
+down_revision: Union[str, None] = 'a7c2d9e4b318'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # константный DEFAULT в Postgres 11+ не переписывает таблицу
+    op.add_column('balances', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('balances', 'version')
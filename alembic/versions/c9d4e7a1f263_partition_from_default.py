@@ -0,0 +1,86 @@
+"""create transactions partitions over rows already in DEFAULT
+
+Revision ID: c9d4e7a1f263
+Revises: b5e8f1c2d9a4
+Create Date: 2026-10-17 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c9d4e7a1f263'
+down_revision: Union[str, None] = 'b5e8f1c2d9a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Если строки месяца уже попали в DEFAULT, CREATE TABLE ... PARTITION OF падает на проверке
+# DEFAULT-партиции. Тогда партиция создаётся отдельной таблицей, строки переносятся в неё
+# и только после этого она присоединяется.
+CREATE_PARTITION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION create_transactions_partition(month_start date) RETURNS void AS $$
+    DECLARE
+        month timestamp := date_trunc('month', month_start::timestamp);
+        partition_name text := 'transactions_' || to_char(month, 'YYYY_MM');
+        range_from timestamptz := month AT TIME ZONE 'UTC';
+        range_to timestamptz := (month + interval '1 month') AT TIME ZONE 'UTC';
+        in_default boolean := false;
+    BEGIN
+        IF to_regclass(partition_name) IS NOT NULL THEN
+            RETURN;
+        END IF;
+        IF to_regclass('transactions_default') IS NOT NULL THEN
+            -- новые сделки месяца не должны попасть в DEFAULT, пока строки переносятся
+            LOCK TABLE transactions_default IN EXCLUSIVE MODE;
+            EXECUTE 'SELECT EXISTS (SELECT 1 FROM transactions_default WHERE timestamp >= $1 AND timestamp < $2)'
+            INTO in_default USING range_from, range_to;
+        END IF;
+
+        IF NOT in_default THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                partition_name, range_from, range_to
+            );
+            RETURN;
+        END IF;
+
+        EXECUTE format('CREATE TABLE %I (LIKE transactions INCLUDING DEFAULTS)', partition_name);
+        EXECUTE format(
+            'WITH moved AS ('
+            '    DELETE FROM transactions_default WHERE timestamp >= $1 AND timestamp < $2 RETURNING *'
+            ') INSERT INTO %I SELECT * FROM moved',
+            partition_name
+        ) USING range_from, range_to;
+        EXECUTE format(
+            'ALTER TABLE transactions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+            partition_name, range_from, range_to
+        );
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+PREVIOUS_PARTITION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION create_transactions_partition(month_start date) RETURNS void AS $$
+    DECLARE
+        month timestamp := date_trunc('month', month_start::timestamp);
+        partition_name text := 'transactions_' || to_char(month, 'YYYY_MM');
+    BEGIN
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+            partition_name,
+            month AT TIME ZONE 'UTC',
+            (month + interval '1 month') AT TIME ZONE 'UTC'
+        );
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+
+def upgrade() -> None:
+    op.execute(CREATE_PARTITION_FUNCTION)
+
+
+def downgrade() -> None:
+    op.execute(PREVIOUS_PARTITION_FUNCTION)
@@ -0,0 +1,29 @@
+"""candles first/last trade times
+
+Revision ID: d2a7f5b9c814
+Revises: c9d4e7a1f263
+Create Date: 2026-10-17 23:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2a7f5b9c814'
+down_revision: Union[str, None] = 'c9d4e7a1f263'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # у уже записанных свечей времени сделок нет: при слиянии их open сохраняется
+    op.add_column('candles', sa.Column('first_trade_at', sa.TIMESTAMP(timezone=True), nullable=True))
+    op.add_column('candles', sa.Column('last_trade_at', sa.TIMESTAMP(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('candles', 'last_trade_at')
+    op.drop_column('candles', 'first_trade_at')
@@ -0,0 +1,38 @@
+"""transactions ticker time index
+
+Revision ID: d81c4b7a5f90
+Revises: 9b3e6f0a2c41
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd81c4b7a5f90'
+down_revision: Union[str, None] = '9b3e6f0a2c41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        # лента сделок по тикеру от новых к старым с keyset-курсором по (timestamp, id)
+        op.create_index(
+            'idx_transactions_ticker_time',
+            'transactions',
+            ['ticker', sa.text('timestamp DESC'), sa.text('id DESC')],
+            postgresql_include=['qty', 'price'],
+            postgresql_concurrently=True,
+        )
+        # новый индекс начинается с ticker, старый одиночный больше не нужен
+        op.drop_index('idx_transactions_ticker', table_name='transactions', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('idx_transactions_ticker', 'transactions', ['ticker'], postgresql_concurrently=True)
+        op.drop_index('idx_transactions_ticker_time', table_name='transactions', postgresql_concurrently=True)
@@ -0,0 +1,58 @@
+"""candles table
+
+Revision ID: e5f27a3b8c16
+Revises: d81c4b7a5f90
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5f27a3b8c16'
+down_revision: Union[str, None] = 'd81c4b7a5f90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INTERVALS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+
+
+def upgrade() -> None:
+    op.create_table(
+        'candles',
+        sa.Column('ticker', sa.String(length=10), sa.ForeignKey('instruments.ticker', ondelete='CASCADE'), nullable=False),
+        sa.Column('period', sa.String(length=3), nullable=False),
+        sa.Column('start_time', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column('open', sa.Integer(), nullable=False),
+        sa.Column('high', sa.Integer(), nullable=False),
+        sa.Column('low', sa.Integer(), nullable=False),
+        sa.Column('close', sa.Integer(), nullable=False),
+        sa.Column('volume', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('trades', sa.Integer(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint('ticker', 'period', 'start_time'),
+    )
+    # свечи по уже накопленным сделкам
+    for period, seconds in INTERVALS.items():
+        op.execute(f"""
+            INSERT INTO candles (ticker, period, start_time, open, high, low, close, volume, trades)
+            SELECT
+                t.ticker,
+                '{period}',
+                to_timestamp(floor(extract(epoch FROM t.timestamp) / {seconds}) * {seconds}) AS start_time,
+                (array_agg(t.price ORDER BY t.timestamp, t.id))[1],
+                max(t.price),
+                min(t.price),
+                (array_agg(t.price ORDER BY t.timestamp DESC, t.id DESC))[1],
+                sum(t.qty),
+                count(*)
+            FROM transactions t
+            JOIN instruments i ON i.ticker = t.ticker
+            GROUP BY t.ticker, start_time
+        """)
+
+
+def downgrade() -> None:
+    op.drop_table('candles')
@@ -0,0 +1,58 @@
+"""orders change sequence
+
+Revision ID: e8b3c6d1a572
+Revises: d2a7f5b9c814
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8b3c6d1a572'
+down_revision: Union[str, None] = 'd2a7f5b9c814'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Каждая вставка и каждое изменение ордера получает следующий номер: снапшот стакана
+# запоминает номер, до которого он актуален, и на старте сверяются только более поздние
+BUMP_CHANGE_SEQ_FUNCTION = """
+    CREATE OR REPLACE FUNCTION orders_bump_change_seq() RETURNS trigger AS $$
+    BEGIN
+        NEW.change_seq := nextval('orders_change_seq');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+
+def upgrade() -> None:
+    op.execute("CREATE SEQUENCE orders_change_seq")
+    # без DEFAULT при добавлении таблица не переписывается; у старых строк NULL —
+    # они старше любого снапшота, снятого после миграции
+    op.add_column('orders', sa.Column('change_seq', sa.BigInteger(), nullable=True))
+    op.execute("ALTER TABLE orders ALTER COLUMN change_seq SET DEFAULT nextval('orders_change_seq')")
+    op.execute(BUMP_CHANGE_SEQ_FUNCTION)
+    op.execute("""
+        CREATE TRIGGER orders_change_seq BEFORE UPDATE ON orders
+        FOR EACH ROW EXECUTE FUNCTION orders_bump_change_seq()
+    """)
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'idx_orders_change_seq',
+            'orders',
+            ['instrument_ticker', 'change_seq'],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('idx_orders_change_seq', table_name='orders', postgresql_concurrently=True)
+    op.execute("DROP TRIGGER IF EXISTS orders_change_seq ON orders")
+    op.execute("DROP FUNCTION IF EXISTS orders_bump_change_seq()")
+    op.drop_column('orders', 'change_seq')
+    op.execute("DROP SEQUENCE IF EXISTS orders_change_seq")
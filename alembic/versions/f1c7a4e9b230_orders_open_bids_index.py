@@ -0,0 +1,39 @@
+"""open bids partial index in matching order
+
+Revision ID: f1c7a4e9b230
+Revises: e8b3c6d1a572
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1c7a4e9b230'
+down_revision: Union[str, None] = 'e8b3c6d1a572'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+OPEN_LIMIT_BIDS = sa.text("status IN ('NEW', 'PARTIALLY_EXECUTED') AND type = 'LIMIT' AND direction = 'BUY'")
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        # Продажа матчится с бидами в порядке (price DESC, timestamp, id): по idx_orders_open_book
+        # этот порядок не читается ни прямым, ни обратным проходом, и над сканом появлялся Sort
+        op.create_index(
+            'idx_orders_open_bids',
+            'orders',
+            ['instrument_ticker', sa.text('price DESC'), 'timestamp', 'id'],
+            postgresql_where=OPEN_LIMIT_BIDS,
+            postgresql_include=['qty', 'filled', 'user_id'],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('idx_orders_open_bids', table_name='orders', postgresql_concurrently=True)
@@ -0,0 +1,109 @@
+"""partition transactions by month
+
+Revision ID: f3a86c2e1d47
+Revises: e5f27a3b8c16
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a86c2e1d47'
+down_revision: Union[str, None] = 'e5f27a3b8c16'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Партиция на календарный месяц по UTC; вызывается приложением заранее на несколько месяцев вперёд
+CREATE_PARTITION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION create_transactions_partition(month_start date) RETURNS void AS $$
+    DECLARE
+        month timestamp := date_trunc('month', month_start::timestamp);
+        partition_name text := 'transactions_' || to_char(month, 'YYYY_MM');
+    BEGIN
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+            partition_name,
+            month AT TIME ZONE 'UTC',
+            (month + interval '1 month') AT TIME ZONE 'UTC'
+        );
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE transactions RENAME TO transactions_plain")
+    op.execute("ALTER TABLE transactions_plain RENAME CONSTRAINT transactions_pkey TO transactions_plain_pkey")
+    op.execute("ALTER INDEX IF EXISTS idx_transactions_ticker_time RENAME TO idx_transactions_plain_ticker_time")
+    op.execute("ALTER INDEX IF EXISTS idx_transactions_timestamp RENAME TO idx_transactions_plain_timestamp")
+
+    # ключ партиционирования обязан входить в первичный ключ
+    op.execute("""
+        CREATE TABLE transactions (
+            id UUID NOT NULL DEFAULT gen_random_uuid(),
+            ticker VARCHAR(10) NOT NULL,
+            qty INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            buy_order_id UUID REFERENCES orders(id) ON DELETE SET NULL,
+            sell_order_id UUID REFERENCES orders(id) ON DELETE SET NULL,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+    op.execute(CREATE_PARTITION_FUNCTION)
+    # партиции под всю имеющуюся историю, текущий и два следующих месяца
+    op.execute("""
+        SELECT create_transactions_partition(month::date)
+        FROM generate_series(
+            date_trunc('month', LEAST(
+                (SELECT min(timestamp) FROM transactions_plain) AT TIME ZONE 'UTC',
+                now() AT TIME ZONE 'UTC'
+            )),
+            date_trunc('month', now() AT TIME ZONE 'UTC') + interval '2 months',
+            interval '1 month'
+        ) AS month
+    """)
+    # страховка, если партиции вперёд не успели создать
+    op.execute("CREATE TABLE transactions_default PARTITION OF transactions DEFAULT")
+
+    op.execute("""
+        INSERT INTO transactions (id, ticker, qty, price, timestamp, buy_order_id, sell_order_id)
+        SELECT id, ticker, qty, price, timestamp, buy_order_id, sell_order_id FROM transactions_plain
+    """)
+    op.execute("DROP TABLE transactions_plain")
+
+    op.execute("""
+        CREATE INDEX idx_transactions_ticker_time ON transactions (ticker, timestamp DESC, id DESC)
+        INCLUDE (qty, price)
+    """)
+    op.execute("CREATE INDEX idx_transactions_timestamp ON transactions (timestamp)")
+
+
+def downgrade() -> None:
+    op.execute("""
+        CREATE TABLE transactions_plain (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            ticker VARCHAR(10) NOT NULL,
+            qty INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            buy_order_id UUID REFERENCES orders(id) ON DELETE SET NULL,
+            sell_order_id UUID REFERENCES orders(id) ON DELETE SET NULL
+        )
+    """)
+    op.execute("""
+        INSERT INTO transactions_plain (id, ticker, qty, price, timestamp, buy_order_id, sell_order_id)
+        SELECT id, ticker, qty, price, timestamp, buy_order_id, sell_order_id FROM transactions
+    """)
+    op.execute("DROP TABLE transactions CASCADE")
+    op.execute("DROP FUNCTION IF EXISTS create_transactions_partition(date)")
+    op.execute("ALTER TABLE transactions_plain RENAME TO transactions")
+    op.execute("ALTER TABLE transactions RENAME CONSTRAINT transactions_plain_pkey TO transactions_pkey")
+    op.execute("""
+        CREATE INDEX idx_transactions_ticker_time ON transactions (ticker, timestamp DESC, id DESC)
+        INCLUDE (qty, price)
+    """)
+    op.execute("CREATE INDEX idx_transactions_timestamp ON transactions (timestamp)")
@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+import time
+from typing import Awaitable, Callable, Dict, Hashable, NamedTuple, Optional, Tuple
+
+
+class CachedResponse(NamedTuple):
+    version: int
+    expires: float
+    body: bytes
+    etag: str
+
+
+class ResponseCache:
+    """
+    Кэш готовых тел ответов (JSON в байтах) по ключу и версии данных.
+    Запись действительна, пока версия не сменилась и (если задан ttl) не истёк срок.
+    Одинаковые запросы во время вычисления ждут одно и то же вычисление (single-flight).
+    """
+
+    def __init__(self, ttl: Optional[float], max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: Dict[Hashable, CachedResponse] = {}
+        self.inflight: Dict[Tuple[Hashable, int], asyncio.Task] = {}
+
+    async def get(
+        self,
+        key: Hashable,
+        version: int,
+        compute: Callable[[], Awaitable[bytes]],
+    ) -> Tuple[bytes, str]:
+        entry = self.entries.get(key)
+        if entry is not None and entry.version == version and (self.ttl is None or time.monotonic() < entry.expires):
+            return entry.body, entry.etag
+
+        flight = (key, version)
+        task = self.inflight.get(flight)
+        if task is None:
+            task = self.inflight[flight] = asyncio.ensure_future(self._fill(key, version, compute))
+            task.add_done_callback(lambda _: self.inflight.pop(flight, None))
+        # отключившийся клиент не должен отменять вычисление для остальных
+        return await asyncio.shield(task)
+
+    async def _fill(self, key: Hashable, version: int, compute) -> Tuple[bytes, str]:
+        body = await compute()
+        # ETag по содержимому: совпадает между воркерами и переживает рестарт
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        expires = time.monotonic() + self.ttl if self.ttl is not None else 0.0
+
+        self.entries.pop(key, None)
+        if len(self.entries) >= self.max_entries:
+            # вытесняем самую старую запись
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = CachedResponse(version, expires, body, etag)
+        return body, etag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
@@ -15,7 +15,7 @@ __all__ = [
     'update_user_balance',
     'get_user_balance',
     'get_transactions',
-    'create_transaction',
+    'insert_transactions',
     'process_limit_order',
     'upload_report'
 ]
\ No newline at end of file
@@ -0,0 +1,440 @@
+import asyncio
+import logging
+import os
+import random
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
+from uuid import UUID
+from fastapi import HTTPException
+from sqlalchemy import delete, event, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from .. import metrics
+from ..models import Balance
+from .ledger import BALANCE_LEDGER, append_ledger_deltas, delete_empty_balances, lock_ledger_balance, lock_ledger_balances
+
+logger = logging.getLogger(__name__)
+
+# Повторяются только откаты, которые Postgres сам предлагает повторить
+RETRY_COUNTERS = {"40P01": "deadlock_retries", "40001": "serialization_retries"}
+BALANCE_MAX_RETRIES = int(os.getenv("BALANCE_MAX_RETRIES", "3"))
+# Базовая задержка перед повтором; растёт вдвое с каждой попыткой, берётся случайная доля
+BALANCE_RETRY_DELAY = float(os.getenv("BALANCE_RETRY_DELAY", "0.05"))
+# Оптимистичный режим: строки balances не блокируются заранее, запись сверяет version
+BALANCE_OPTIMISTIC = os.getenv("BALANCE_OPTIMISTIC", "0") == "1"
+
+BalanceKey = Tuple[UUID, str]
+# (user_id, тикер) -> (изменение amount, изменение locked)
+BalanceDeltas = Dict[BalanceKey, Tuple[int, int]]
+
+T = TypeVar("T")
+
+# Версии балансов пользователей для кэша GET /balance. Растут после коммита транзакции,
+# которая меняла баланс, — до того, как запрос, сделавший изменение, получит ответ.
+BALANCE_VERSIONS: Dict[str, int] = {}
+# Сбрасывает версии всех пользователей разом (например, при удалении инструмента)
+BALANCE_GENERATION = 0
+_CHANGED_USERS = "balance_changed_users"
+
+_UPDATE_BALANCE_DELTAS = text("""
+    UPDATE balances AS b
+    SET amount = b.amount + d.amount,
+        locked = b.locked + d.locked,
+        version = b.version + 1
+    FROM unnest(
+        CAST(:user_ids AS uuid[]),
+        CAST(:tickers AS varchar[]),
+        CAST(:amounts AS integer[]),
+        CAST(:locked AS integer[])
+    ) AS d(user_id, instrument_ticker, amount, locked)
+    WHERE b.user_id = d.user_id
+      AND b.instrument_ticker = d.instrument_ticker
+""")
+
+_UPSERT_BALANCE_DELTAS = text("""
+    INSERT INTO balances (user_id, instrument_ticker, amount, locked)
+    SELECT d.user_id, d.instrument_ticker, d.amount, d.locked
+    FROM unnest(
+        CAST(:user_ids AS uuid[]),
+        CAST(:tickers AS varchar[]),
+        CAST(:amounts AS integer[]),
+        CAST(:locked AS integer[])
+    ) AS d(user_id, instrument_ticker, amount, locked)
+    ORDER BY d.user_id, d.instrument_ticker
+    ON CONFLICT (user_id, instrument_ticker) DO UPDATE
+    SET amount = balances.amount + excluded.amount,
+        locked = balances.locked + excluded.locked,
+        version = balances.version + 1
+""")
+
+# Ключи передаются массивами, а не IN (...): число параметров запроса не зависит от размера пакета
+_LOCK_BALANCES = text("""
+    SELECT b.user_id, b.instrument_ticker, b.amount, b.locked
+    FROM balances AS b
+    JOIN unnest(CAST(:user_ids AS uuid[]), CAST(:tickers AS varchar[])) AS d(user_id, instrument_ticker)
+      ON b.user_id = d.user_id AND b.instrument_ticker = d.instrument_ticker
+    ORDER BY b.user_id, b.instrument_ticker
+    FOR UPDATE OF b
+""")
+
+_KNOWN_USERS = text("SELECT id FROM users WHERE id = ANY(CAST(:ids AS uuid[]))")
+_KNOWN_TICKERS = text("SELECT ticker FROM instruments WHERE ticker = ANY(CAST(:tickers AS varchar[]))")
+
+_READ_BALANCE_VERSIONS = text("""
+    SELECT b.user_id, b.instrument_ticker, b.amount, b.locked, b.version
+    FROM balances AS b
+    JOIN unnest(CAST(:user_ids AS uuid[]), CAST(:tickers AS varchar[])) AS d(user_id, instrument_ticker)
+      ON b.user_id = d.user_id AND b.instrument_ticker = d.instrument_ticker
+""")
+
+_UPDATE_BALANCE_VERSION = text("""
+    UPDATE balances
+    SET amount = amount + :amount,
+        locked = locked + :locked,
+        version = version + 1
+    WHERE user_id = :user_id
+      AND instrument_ticker = :ticker
+      AND version = :version
+    RETURNING version
+""")
+
+_INSERT_BALANCE = text("""
+    INSERT INTO balances (user_id, instrument_ticker, amount, locked)
+    VALUES (:user_id, :ticker, :amount, :locked)
+    ON CONFLICT (user_id, instrument_ticker) DO NOTHING
+    RETURNING version
+""")
+
+
+class BalanceConflict(Exception):
+    """Строка balances изменилась после чтения — транзакцию нужно повторить, как при 40001."""
+    sqlstate = "40001"
+
+
+def balance_key(user_id, ticker: str) -> BalanceKey:
+    return (user_id if isinstance(user_id, UUID) else UUID(str(user_id)), ticker)
+
+
+def balance_version(user_id) -> Tuple[int, int]:
+    return BALANCE_GENERATION, BALANCE_VERSIONS.get(str(user_id), 0)
+
+
+def forget_balances() -> None:
+    global BALANCE_GENERATION
+    BALANCE_GENERATION += 1
+    BALANCE_VERSIONS.clear()
+
+
+def _touch(db: AsyncSession, keys: Iterable[BalanceKey]) -> None:
+    # версии поднимутся только после коммита; при откате список просто выбрасывается
+    changed: Set[str] = db.sync_session.info.setdefault(_CHANGED_USERS, set())
+    changed.update(str(key[0]) for key in keys)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_balance_versions(session: Session) -> None:
+    for user_id in session.info.pop(_CHANGED_USERS, ()):
+        BALANCE_VERSIONS[user_id] = BALANCE_VERSIONS.get(user_id, 0) + 1
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_balance_changes(session: Session) -> None:
+    session.info.pop(_CHANGED_USERS, None)
+
+
+def sqlstate(exc: BaseException) -> Optional[str]:
+    """SQLSTATE ошибки БД: адаптер asyncpg в SQLAlchemy кладёт его в orig.sqlstate / orig.pgcode."""
+    orig = getattr(exc, "orig", exc)
+    for candidate in (orig, getattr(orig, "__cause__", None)):
+        code = getattr(candidate, "sqlstate", None) or getattr(candidate, "pgcode", None)
+        if code:
+            return code
+    return None
+
+
+async def run_with_retries(
+    db: AsyncSession,
+    operation: Callable[[], Awaitable[T]],
+    name: str,
+    on_retry: Optional[Callable[[], Awaitable[None]]] = None,
+) -> T:
+    """
+    Выполняет operation — транзакцию целиком, вместе с коммитом. При дедлоке (40P01),
+    ошибке сериализации (40001) или конфликте версии balances откатывает её и повторяет
+    с задержкой и джиттером. on_retry вызывается после отката — например, чтобы
+    вернуть стакан в памяти к состоянию БД.
+    """
+    for attempt in range(1, BALANCE_MAX_RETRIES + 1):
+        try:
+            return await operation()
+        except (DBAPIError, BalanceConflict) as e:
+            code = sqlstate(e)
+            if code not in RETRY_COUNTERS:
+                raise
+            await db.rollback()
+            if on_retry is not None:
+                await on_retry()
+            metrics.inc(RETRY_COUNTERS[code])
+            logger.warning(f"SQLSTATE {code} in {name}, retry {attempt}")
+            await asyncio.sleep(random.uniform(0, BALANCE_RETRY_DELAY * 2 ** attempt))
+    metrics.inc("balance_retries_exhausted")
+    raise HTTPException(status_code=500, detail="Сервер перегружен, попробуйте позже")
+
+
+async def lock_balances(db: AsyncSession, keys: Iterable[BalanceKey]) -> Dict[BalanceKey, Tuple[int, int]]:
+    """
+    Захватывает строки balances одним SELECT ... FOR UPDATE в порядке (user_id, тикер)
+    и возвращает их (amount, locked); несуществующих ключей в ответе нет. Транзакция
+    берёт блокировки balances только здесь и только один раз, поэтому два расчёта
+    не могут захватить строки крест-накрест.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return {}
+    result = await db.execute(_LOCK_BALANCES, {
+        "user_ids": [user_id for user_id, _ in keys],
+        "tickers": [ticker for _, ticker in keys],
+    })
+    return {(user_id, ticker): (amount or 0, locked or 0) for user_id, ticker, amount, locked in result}
+
+
+async def lock_user_balances(db: AsyncSession, user_id) -> None:
+    """
+    Захватывает все строки balances пользователя в порядке ключа — для операций,
+    которые затем трогают уровни стакана и ордера (как расчёт сделки).
+    """
+    await db.execute(
+        select(Balance.user_id)
+        .where(Balance.user_id == user_id)
+        .order_by(Balance.instrument_ticker)
+        .with_for_update()
+    )
+
+
+def _delta_params(rows: List[Tuple[BalanceKey, int, int]]) -> Dict[str, list]:
+    return {
+        "user_ids": [key[0] for key, _, _ in rows],
+        "tickers": [key[1] for key, _, _ in rows],
+        "amounts": [amount for _, amount, _ in rows],
+        "locked": [locked for _, _, locked in rows],
+    }
+
+
+def _insufficient(key: BalanceKey, required: int) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"Недостаточно {key[1]} (требуется {required})")
+
+
+async def apply_balance_deltas(
+    db: AsyncSession,
+    deltas: BalanceDeltas,
+    reserve: Optional[Dict[BalanceKey, int]] = None,
+) -> None:
+    """
+    Применяет суммарные изменения (amount, locked) в текущей транзакции: одна блокировка
+    всех строк, один UPDATE по существующим и один upsert для недостающих.
+    reserve — сколько свободного остатка нужно по ключу до изменений (блокировка под
+    новый ордер); проверяется под той же блокировкой.
+
+    В режиме журнала строки balances не трогаются: сделка только списывает то, что
+    было залочено при выставлении ордера, и зачисляет, поэтому изменения просто
+    дописываются в balance_ledger.
+    """
+    deltas = {balance_key(*key): delta for key, delta in deltas.items() if delta != (0, 0)}
+    reserve = {balance_key(*key): amount for key, amount in (reserve or {}).items()}
+    if not deltas:
+        return
+    _touch(db, deltas)
+
+    if BALANCE_LEDGER:
+        for key in sorted(reserve):
+            amount, locked = await lock_ledger_balance(db, *key)
+            if amount - locked < reserve[key]:
+                raise _insufficient(key, reserve[key])
+        await append_ledger_deltas(db, deltas)
+        return
+
+    def check(key: BalanceKey, current: Optional[Tuple[int, int]]) -> Tuple[int, int]:
+        amount_delta, locked_delta = deltas[key]
+        amount, locked = current or (0, 0)
+        if amount - locked < reserve.get(key, 0):
+            raise _insufficient(key, reserve[key])
+        if locked + locked_delta < 0 or amount + amount_delta < locked + locked_delta:
+            # уменьшают баланс только покупатель (RUB) и продавец (актив)
+            if key[1] == "RUB":
+                raise HTTPException(400, detail="Недостаточно залоченных средств у покупателя")
+            raise HTTPException(400, detail="Недостаточно залоченных активов у продавца")
+        return amount_delta, locked_delta
+
+    await _mutate(db, deltas, check)
+
+
+async def release_balance(db: AsyncSession, user_id, ticker: str, amount: int) -> None:
+    """Снимает блокировку amount (отмена ордера); без коммита."""
+    key = balance_key(user_id, ticker)
+    _touch(db, [key])
+    if BALANCE_LEDGER:
+        _, locked = await lock_ledger_balance(db, *key)
+        if locked < amount:
+            raise HTTPException(status_code=400, detail="Not enough locked balance")
+        await append_ledger_deltas(db, {key: (0, -amount)})
+        return
+
+    def check(key: BalanceKey, current: Optional[Tuple[int, int]]) -> Tuple[int, int]:
+        if current is None:
+            raise HTTPException(status_code=400, detail="Balance not found")
+        if current[1] < amount:
+            raise HTTPException(status_code=400, detail="Not enough locked balance")
+        return 0, -amount
+
+    await _mutate(db, [key], check)
+
+
+async def change_balance(db: AsyncSession, user_id, ticker: str, amount: int) -> None:
+    """Зачисление (amount > 0) или списание свободного остатка; без коммита. Обнулившаяся строка удаляется."""
+    key = balance_key(user_id, ticker)
+    _touch(db, [key])
+    if BALANCE_LEDGER:
+        total, locked = await lock_ledger_balance(db, *key)
+        if total + amount < locked:
+            raise ValueError("Недостаточно доступных средств (учитывая заблокированные)")
+        await append_ledger_deltas(db, {key: (amount, 0)})
+        return
+
+    emptied = False
+
+    def check(key: BalanceKey, current: Optional[Tuple[int, int]]) -> Tuple[int, int]:
+        nonlocal emptied
+        if current is None and amount < 0:
+            raise ValueError("Нельзя снять средства с несуществующего баланса")
+        balance, locked = current or (0, 0)
+        if balance + amount < locked:
+            raise ValueError("Недостаточно доступных средств (учитывая заблокированные)")
+        emptied = balance + amount == 0 and locked == 0
+        return amount, 0
+
+    await _mutate(db, [key], check)
+    if emptied:
+        await db.execute(
+            delete(Balance).where(
+                Balance.user_id == key[0],
+                Balance.instrument_ticker == ticker,
+                Balance.amount == 0,
+                Balance.locked == 0,
+            )
+        )
+
+
+async def change_balances(db: AsyncSession, items) -> List[Optional[str]]:
+    """
+    Пакет зачислений и списаний (schemas.BalanceBatchItem) в текущей транзакции, без коммита.
+    Пользователи и инструменты проверяются двумя запросами на весь пакет, операции
+    проводятся по порядку на копии остатков, а в БД уходит одно изменение на счёт —
+    одним INSERT ... ON CONFLICT DO UPDATE. Возвращает ошибку по каждой операции (None — успешно).
+    """
+    known_users = set((await db.execute(
+        _KNOWN_USERS, {"ids": list({item.user_id for item in items})}
+    )).scalars())
+    known_tickers = set((await db.execute(
+        _KNOWN_TICKERS, {"tickers": list({item.ticker for item in items})}
+    )).scalars())
+
+    errors: List[Optional[str]] = [None] * len(items)
+    keys: Set[BalanceKey] = set()
+    for i, item in enumerate(items):
+        if item.user_id not in known_users:
+            errors[i] = "Пользователь не найден"
+        elif item.ticker not in known_tickers:
+            errors[i] = "Инструмент не найден"
+        else:
+            keys.add(balance_key(item.user_id, item.ticker))
+    if not keys:
+        return errors
+    _touch(db, keys)
+
+    # пустая строка balances создаётся только там, где есть списание: без неё нечего блокировать
+    withdrawals = {
+        balance_key(item.user_id, item.ticker)
+        for i, item in enumerate(items)
+        if errors[i] is None and item.operation != "DEPOSIT"
+    }
+    if BALANCE_LEDGER:
+        current = await lock_ledger_balances(db, keys, create=withdrawals)
+    else:
+        current = await lock_balances(db, keys)
+
+    deltas: Dict[BalanceKey, int] = {}
+    for i, item in enumerate(items):
+        if errors[i] is not None:
+            continue
+        key = balance_key(item.user_id, item.ticker)
+        amount, locked = current.get(key, (0, 0))
+        change = item.amount if item.operation == "DEPOSIT" else -item.amount
+        if amount + deltas.get(key, 0) + change < locked:
+            errors[i] = "Недостаточно средств на балансе"
+            continue
+        deltas[key] = deltas.get(key, 0) + change
+
+    rows = [(key, amount, 0) for key, amount in sorted(deltas.items()) if amount]
+    if BALANCE_LEDGER:
+        await append_ledger_deltas(db, {key: (amount, 0) for key, amount, _ in rows})
+        # строки, созданные под отклонённые списания, не оставляем
+        await delete_empty_balances(db, sorted(withdrawals))
+        return errors
+
+    if rows:
+        await db.execute(_UPSERT_BALANCE_DELTAS, _delta_params(rows))
+    await delete_empty_balances(db, [
+        key for key, amount, _ in rows
+        if current.get(key, (0, 0)) == (-amount, 0)
+    ])
+    return errors
+
+
+# Проверка одного счёта: по текущим (amount, locked) или None, если строки нет,
+# возвращает изменение (amount, locked) либо бросает исключение
+BalanceCheck = Callable[[BalanceKey, Optional[Tuple[int, int]]], Tuple[int, int]]
+
+
+async def _mutate(db: AsyncSession, keys: Iterable[BalanceKey], check: BalanceCheck) -> None:
+    if BALANCE_OPTIMISTIC:
+        await _mutate_optimistic(db, keys, check)
+        return
+
+    current = await lock_balances(db, keys)
+    existing, missing = [], []
+    for key in sorted(set(keys)):
+        amount_delta, locked_delta = check(key, current.get(key))
+        (existing if key in current else missing).append((key, amount_delta, locked_delta))
+
+    if existing:
+        await db.execute(_UPDATE_BALANCE_DELTAS, _delta_params(existing))
+    if missing:
+        await db.execute(_UPSERT_BALANCE_DELTAS, _delta_params(missing))
+
+
+async def _mutate_optimistic(db: AsyncSession, keys: Iterable[BalanceKey], check: BalanceCheck) -> None:
+    """
+    Оптимистичный режим: строки читаются без блокировок, каждая пишется условным
+    UPDATE ... WHERE version = :version (или INSERT ... ON CONFLICT DO NOTHING для новой)
+    в порядке ключа. Первый же конфликт версии бросает BalanceConflict: транзакция
+    откатывается целиком и повторяется через run_with_retries, поэтому строки внутри
+    одной попытки всегда захватываются в порядке ключа.
+    """
+    pending = sorted(set(keys))
+    result = await db.execute(_READ_BALANCE_VERSIONS, {
+        "user_ids": [user_id for user_id, _ in pending],
+        "tickers": [ticker for _, ticker in pending],
+    })
+    current = {(user_id, ticker): (amount or 0, locked or 0, version) for user_id, ticker, amount, locked, version in result}
+
+    for key in pending:
+        row = current.get(key)
+        amount_delta, locked_delta = check(key, row[:2] if row else None)
+        params = {"user_id": key[0], "ticker": key[1], "amount": amount_delta, "locked": locked_delta}
+        if row is None:
+            written = await db.execute(_INSERT_BALANCE, params)
+        else:
+            written = await db.execute(_UPDATE_BALANCE_VERSION, {**params, "version": row[2]})
+        if written.first() is None:
+            metrics.inc("balance_version_conflicts")
+            raise BalanceConflict(f"balance {key[0]}/{key[1]} changed concurrently")
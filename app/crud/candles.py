@@ -0,0 +1,54 @@
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import models, schemas
+from ..engine import open_candle
+
+
+async def get_candles(
+    db: AsyncSession,
+    ticker: str,
+    period: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = 500,
+) -> List[schemas.Candle]:
+    """
+    Свечи периода [since, until) по возрастанию времени: закрытые — из таблицы candles
+    (диапазон по первичному ключу), текущая — из памяти.
+    """
+    c = models.Candle
+    stmt = select(c).where(c.ticker == ticker, c.period == period)
+    if since is not None:
+        stmt = stmt.where(c.start_time >= since)
+    if until is not None:
+        stmt = stmt.where(c.start_time < until)
+    result = await db.execute(stmt.order_by(c.start_time.desc()).limit(limit))
+    rows = list(reversed(result.scalars().all()))
+    candles = [schemas.Candle.model_validate(row) for row in rows]
+
+    current = open_candle(ticker, period)
+    if current is None:
+        return candles
+    if (since is not None and current.start_time < since) or (until is not None and current.start_time >= until):
+        return candles
+
+    live = schemas.Candle.model_validate(current)
+    if candles and candles[-1].start_time == live.start_time:
+        # часть периода уже записана (до рестарта или другим воркером) — досливаем
+        # по времени сделок, как _UPSERT_CANDLE
+        stored, row = candles[-1], rows[-1]
+        live = schemas.Candle(
+            start_time=stored.start_time,
+            open=live.open if row.first_trade_at is not None and current.first_trade_at < row.first_trade_at else stored.open,
+            high=max(stored.high, live.high),
+            low=min(stored.low, live.low),
+            close=live.close if row.last_trade_at is None or current.last_trade_at >= row.last_trade_at else stored.close,
+            volume=stored.volume + live.volume,
+            trades=stored.trades + live.trades,
+        )
+        candles[-1] = live
+    else:
+        candles.append(live)
+    return candles[-limit:]
@@ -0,0 +1,188 @@
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+from sqlalchemy import delete, func, select, text, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import metrics
+from ..models import Balance, BalanceLedger
+
+# Режим журнала: сделки не обновляют строки balances, а дописывают изменения в balance_ledger
+BALANCE_LEDGER = os.getenv("BALANCE_LEDGER", "0") == "1"
+# Сколько строк журнала сворачивать в balances за одну транзакцию
+BALANCE_LEDGER_COMPACT_BATCH = int(os.getenv("BALANCE_LEDGER_COMPACT_BATCH", "10000"))
+
+# (user_id, тикер) -> (изменение amount, изменение locked)
+LedgerDeltas = Dict[Tuple[UUID, str], Tuple[int, int]]
+
+_APPEND_LEDGER = text("""
+    INSERT INTO balance_ledger (user_id, instrument_ticker, amount, locked)
+    SELECT * FROM unnest(
+        CAST(:user_ids AS uuid[]),
+        CAST(:tickers AS varchar[]),
+        CAST(:amounts AS integer[]),
+        CAST(:locked AS integer[])
+    )
+""")
+
+# Строки журнала удаляются и прибавляются к balances одним запросом: читатель видит
+# либо старую базу вместе с журналом, либо новую базу без него
+_COMPACT_LEDGER = text("""
+    WITH moved AS (
+        DELETE FROM balance_ledger
+        WHERE id IN (SELECT id FROM balance_ledger ORDER BY id LIMIT :batch)
+        RETURNING user_id, instrument_ticker, amount, locked
+    ),
+    folded AS (
+        INSERT INTO balances (user_id, instrument_ticker, amount, locked)
+        SELECT user_id, instrument_ticker, CAST(sum(amount) AS integer), CAST(sum(locked) AS integer)
+        FROM moved
+        GROUP BY user_id, instrument_ticker
+        ORDER BY user_id, instrument_ticker
+        ON CONFLICT (user_id, instrument_ticker) DO UPDATE
+        SET amount = balances.amount + excluded.amount,
+            locked = balances.locked + excluded.locked,
+            version = balances.version + 1
+        RETURNING user_id, instrument_ticker, amount, locked
+    )
+    SELECT user_id, instrument_ticker, amount, locked, (SELECT count(*) FROM moved) AS moved
+    FROM folded
+""")
+
+_CREATE_BASE_ROWS = text("""
+    INSERT INTO balances (user_id, instrument_ticker, amount, locked)
+    SELECT d.user_id, d.instrument_ticker, 0, 0
+    FROM unnest(CAST(:user_ids AS uuid[]), CAST(:tickers AS varchar[])) AS d(user_id, instrument_ticker)
+    ORDER BY d.user_id, d.instrument_ticker
+    ON CONFLICT (user_id, instrument_ticker) DO NOTHING
+""")
+
+_LOCK_BASE_ROWS = text("""
+    SELECT b.user_id
+    FROM balances AS b
+    JOIN unnest(CAST(:user_ids AS uuid[]), CAST(:tickers AS varchar[])) AS d(user_id, instrument_ticker)
+      ON b.user_id = d.user_id AND b.instrument_ticker = d.instrument_ticker
+    ORDER BY b.user_id, b.instrument_ticker
+    FOR UPDATE OF b
+""")
+
+# Читается отдельным запросом после блокировки: снимок берётся уже после возможного
+# ожидания свёртки, иначе свёрнутые строки журнала посчитались бы дважды
+_LEDGER_TOTALS = text("""
+    SELECT d.user_id, d.instrument_ticker,
+           COALESCE(b.amount, 0) + COALESCE(l.amount, 0),
+           COALESCE(b.locked, 0) + COALESCE(l.locked, 0)
+    FROM unnest(CAST(:user_ids AS uuid[]), CAST(:tickers AS varchar[])) AS d(user_id, instrument_ticker)
+    LEFT JOIN balances AS b
+      ON b.user_id = d.user_id AND b.instrument_ticker = d.instrument_ticker
+    LEFT JOIN LATERAL (
+        SELECT sum(amount) AS amount, sum(locked) AS locked
+        FROM balance_ledger
+        WHERE user_id = d.user_id AND instrument_ticker = d.instrument_ticker
+    ) AS l ON true
+""")
+
+_DELETE_EMPTY_BALANCES = text("""
+    DELETE FROM balances AS b
+    USING unnest(CAST(:user_ids AS uuid[]), CAST(:tickers AS varchar[])) AS d(user_id, instrument_ticker)
+    WHERE b.user_id = d.user_id
+      AND b.instrument_ticker = d.instrument_ticker
+      AND b.amount = 0
+      AND b.locked = 0
+""")
+
+
+async def append_ledger_deltas(db: AsyncSession, deltas: LedgerDeltas) -> None:
+    """Дописывает изменения одним INSERT, без блокировок строк balances."""
+    rows = sorted((key, delta) for key, delta in deltas.items() if delta != (0, 0))
+    if not rows:
+        return
+    await db.execute(_APPEND_LEDGER, {
+        "user_ids": [key[0] for key, _ in rows],
+        "tickers": [key[1] for key, _ in rows],
+        "amounts": [delta[0] for _, delta in rows],
+        "locked": [delta[1] for _, delta in rows],
+    })
+
+
+def balance_totals_stmt(user_id, ticker: Optional[str] = None):
+    """(тикер, amount, locked): база из balances плюс ещё не свёрнутый журнал."""
+    base = select(
+        Balance.instrument_ticker,
+        func.coalesce(Balance.amount, 0).label("amount"),
+        func.coalesce(Balance.locked, 0).label("locked"),
+    ).where(Balance.user_id == user_id)
+    pending = select(
+        BalanceLedger.instrument_ticker, BalanceLedger.amount, BalanceLedger.locked
+    ).where(BalanceLedger.user_id == user_id)
+    if ticker is not None:
+        base = base.where(Balance.instrument_ticker == ticker)
+        pending = pending.where(BalanceLedger.instrument_ticker == ticker)
+
+    rows = union_all(base, pending).subquery()
+    return (
+        select(rows.c.instrument_ticker, func.sum(rows.c.amount), func.sum(rows.c.locked))
+        .group_by(rows.c.instrument_ticker)
+        .order_by(rows.c.instrument_ticker)
+    )
+
+
+def _key_params(keys: List[Tuple[UUID, str]]) -> Dict[str, list]:
+    return {"user_ids": [user_id for user_id, _ in keys], "tickers": [ticker for _, ticker in keys]}
+
+
+async def lock_ledger_balances(
+    db: AsyncSession,
+    keys: Iterable[Tuple[UUID, str]],
+    create: Iterable[Tuple[UUID, str]] = (),
+) -> Dict[Tuple[UUID, str], Tuple[int, int]]:
+    """
+    Захватывает строки balances по ключам в порядке ключа и возвращает итоговые
+    (amount, locked) с учётом журнала — три запроса на любое число ключей. Для ключей
+    из create недостающая строка сначала создаётся пустой, чтобы было что блокировать.
+    Блокировка сериализует только проверки свободного остатка (ордера, вывод, отмена);
+    сделки её не ждут — они лишь списывают ранее залоченное и зачисляют, свободный
+    остаток от них не уменьшается.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return {}
+    create = sorted(set(create))
+    if create:
+        await db.execute(_CREATE_BASE_ROWS, _key_params(create))
+    await db.execute(_LOCK_BASE_ROWS, _key_params(keys))
+    result = await db.execute(_LEDGER_TOTALS, _key_params(keys))
+    return {(user_id, ticker): (int(amount), int(locked)) for user_id, ticker, amount, locked in result}
+
+
+async def lock_ledger_balance(db: AsyncSession, user_id, ticker: str) -> Tuple[int, int]:
+    """Один счёт: строка balances при необходимости создаётся, см. lock_ledger_balances."""
+    key = (user_id if isinstance(user_id, UUID) else UUID(str(user_id)), ticker)
+    return (await lock_ledger_balances(db, [key], create=[key]))[key]
+
+
+async def delete_empty_balances(db: AsyncSession, keys: List[Tuple[UUID, str]]) -> None:
+    """Удаляет обнулившиеся строки balances по ключам — как при обычном списании до нуля."""
+    if keys:
+        await db.execute(_DELETE_EMPTY_BALANCES, _key_params(keys))
+
+
+async def delete_user_ledger(db: AsyncSession, user_id) -> None:
+    await db.execute(delete(BalanceLedger).where(BalanceLedger.user_id == user_id))
+
+
+async def compact_ledger(db: AsyncSession) -> int:
+    """
+    Сворачивает до BALANCE_LEDGER_COMPACT_BATCH строк журнала в balances и коммитит.
+    Обнулившиеся строки balances удаляются, как при обычном обновлении баланса.
+    Возвращает число свёрнутых строк журнала.
+    """
+    rows = (await db.execute(_COMPACT_LEDGER, {"batch": BALANCE_LEDGER_COMPACT_BATCH})).all()
+    empty: List[Tuple[UUID, str]] = [
+        (user_id, ticker) for user_id, ticker, amount, locked, _ in rows if amount == 0 and locked == 0
+    ]
+    await delete_empty_balances(db, empty)
+    await db.commit()
+
+    moved = rows[0].moved if rows else 0
+    metrics.inc("ledger_compacted_rows", moved)
+    return moved
@@ -1,48 +1,48 @@
-from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
 from .. import models
-from ..schemas import Level, L2OrderBook
+from ..engine import BUY, IN_MEMORY, SELL, BookView, book_view, ticker_snapshot
+from ..schemas import Level, L2OrderBook, TickerInfo
+from .price_levels import get_price_levels
 from typing import Optional
 
-async def get_orderbook_data(db: AsyncSession, ticker: str, limit: int = 10) -> Optional[L2OrderBook]:
 
-    bids_result = await db.execute(
-        select(
-            models.Order.price,
-            func.sum(models.Order.qty - models.Order.filled).label("total_qty")
-        )
-        .where(
-            models.Order.instrument_ticker == ticker,
-            models.Order.direction == models.OrderDirection.BUY,
-            models.Order.status.in_([models.OrderStatus.NEW, models.OrderStatus.PARTIALLY_EXECUTED]),
-            models.Order.type == models.OrderType.LIMIT
-        )
-        .group_by(models.Order.price)
-        .order_by(
-            models.Order.price.desc(),
-        )
-        .limit(limit)
-    )
-    bids = [Level(price=price, qty=int(qty)) for price, qty in bids_result]
-
-    asks_result = await db.execute(
-        select(
-            models.Order.price,
-            func.sum(models.Order.qty - models.Order.filled).label("total_qty")
-        )
-        .where(
-            models.Order.instrument_ticker == ticker,
-            models.Order.direction == models.OrderDirection.SELL,
-            models.Order.status.in_([models.OrderStatus.NEW, models.OrderStatus.PARTIALLY_EXECUTED]),
-            models.Order.type == models.OrderType.LIMIT
-        )
-        .group_by(models.Order.price)
-        .order_by(
-            models.Order.price.asc(),
-        )
-        .limit(limit)
+def _book_to_l2(view: BookView, limit: int) -> L2OrderBook:
+    return L2OrderBook(
+        bid_levels=[Level(price=price, qty=qty) for price, qty in view.top_levels(BUY, limit)],
+        ask_levels=[Level(price=price, qty=qty) for price, qty in view.top_levels(SELL, limit)],
     )
-    asks = [Level(price=price, qty=int(qty)) for price, qty in asks_result]
+
+
+def get_memory_orderbook(ticker: str, limit: int = 10) -> Optional[L2OrderBook]:
+    """
+    L2 из опубликованных уровней стакана в памяти: они обновляются после каждого коммита,
+    запрос к БД не нужен. None — стакана по тикеру нет (или режим sql).
+    """
+    if not IN_MEMORY:
+        return None
+    view = book_view(ticker)
+    if view is None:
+        return None
+    return _book_to_l2(view, limit)
+
+
+async def get_orderbook_data(db: AsyncSession, ticker: str, limit: int = 10) -> Optional[L2OrderBook]:
+    if IN_MEMORY:
+        view = book_view(ticker)
+        if view is None or view.is_empty():
+            return None
+        return _book_to_l2(view, limit)
+
+    # уровни ведутся в price_levels вместе с ордерами — читаем готовые агрегаты
+    bids = [
+        Level(price=price, qty=qty)
+        for price, qty in await get_price_levels(db, ticker, models.OrderDirection.BUY, limit)
+    ]
+    asks = [
+        Level(price=price, qty=qty)
+        for price, qty in await get_price_levels(db, ticker, models.OrderDirection.SELL, limit)
+    ]
 
     if not bids and not asks:
         return None
@@ -50,4 +50,38 @@ async def get_orderbook_data(db: AsyncSession, ticker: str, limit: int = 10) ->
     return L2OrderBook(
         bid_levels=bids,
         ask_levels=asks
-    )
\ No newline at end of file
+    )
+
+
+async def get_ticker_info(db: AsyncSession, ticker: str) -> Optional[TickerInfo]:
+    """
+    Лучшие цены и последняя сделка. В режиме memory — без обращения к БД;
+    в режиме sql — верхний уровень каждой стороны из price_levels и последняя сделка.
+    None — по тикеру нет ни стакана, ни сделок.
+    """
+    if IN_MEMORY:
+        snapshot = ticker_snapshot(ticker)
+        return TickerInfo(**snapshot) if snapshot is not None else None
+
+    bids = await get_price_levels(db, ticker, models.OrderDirection.BUY, 1)
+    asks = await get_price_levels(db, ticker, models.OrderDirection.SELL, 1)
+    last = (await db.execute(
+        select(models.Transaction.price, models.Transaction.qty, models.Transaction.timestamp)
+        .where(models.Transaction.ticker == ticker)
+        .order_by(models.Transaction.timestamp.desc())
+        .limit(1)
+    )).first()
+    if not bids and not asks and last is None:
+        return None
+
+    best_bid = bids[0][0] if bids else None
+    best_ask = asks[0][0] if asks else None
+    return TickerInfo(
+        ticker=ticker,
+        best_bid=best_bid,
+        best_ask=best_ask,
+        spread=best_ask - best_bid if best_bid is not None and best_ask is not None else None,
+        last_price=last.price if last else None,
+        last_qty=last.qty if last else None,
+        last_timestamp=last.timestamp if last else None,
+    )
@@ -1,15 +1,32 @@
-from sqlalchemy import select,and_
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import HTTPException
 from .. import models, schemas
 from ..crud.instruments import get_instrument_by_ticker
-from ..crud.balances import get_user_balance, lock_user_balance, ensure_and_lock_balance
+from ..crud.balances import get_available_balance
+from ..crud.balance_access import release_balance, run_with_retries
+from ..crud.price_levels import apply_level_deltas
+from ..crud.transactions import trade_timestamp
 import logging
 from ..schemas import OrderStatus
-from ..models import Order,OrderDirection
-from ..matching import execute_limit_order,execute_market_order
+from ..models import OrderType
+from ..matching import execute_limit_order,execute_market_order,execute_auction,market_depth
+from ..engine import is_auction, publish_book, record_candle_trade, record_last_trade, rest_order, rollback_book, unrest_order
 
 logger = logging.getLogger(__name__) 
 
+
+def _publish(ticker: str, settlement) -> None:
+    """После коммита: рассылка изменений стакана, последняя сделка для /ticker и свечи."""
+    publish_book(ticker)
+    if settlement is None or not settlement.trades:
+        return
+    # то же время, что записано в transactions
+    for i, trade in enumerate(settlement.trades):
+        record_candle_trade(ticker, trade.price, trade.qty, trade_timestamp(settlement.timestamp, i))
+    last = settlement.trades[-1]
+    record_last_trade(ticker, last.price, last.qty, trade_timestamp(settlement.timestamp, len(settlement.trades) - 1))
+
 async def get_order_by_id(db: AsyncSession, order_id: str, user_id: str = None):
     stmt = select(models.Order).where(models.Order.id == order_id)
     if user_id:
@@ -24,109 +41,189 @@ async def get_orders_by_user_id(db: AsyncSession, user_id: str):
     )
     return result.scalars().all()
 
+async def _process_market_order(db: AsyncSession, order_data: schemas.MarketOrderBody, user_id: str):
+    instrument = await get_instrument_by_ticker(db, order_data.ticker)
+    if not instrument:
+        raise ValueError(f"Инструмент {order_data.ticker} не найден")
+    # между раундами аукциона стакан может быть пересечён: исполнение по нему в обход
+    # единой цены аукциона ломало бы сам аукцион
+    if is_auction(order_data.ticker):
+        raise ValueError(f"Инструмент {order_data.ticker} торгуется в режиме аукциона, рыночные заявки не принимаются")
+
+    db_order = models.Order(
+        user_id=user_id,
+        direction=order_data.direction,
+        instrument_ticker=order_data.ticker,
+        qty=order_data.qty,
+        price=None,
+        type="MARKET",
+        status=OrderStatus.NEW,
+        filled=0
+    )
+    db.add(db_order)
+    await db.flush()
+
+    # Сколько объёма есть в стакане и во что обойдётся исполнение — без загрузки самих ордеров
+    total_available_qty, cost = await market_depth(db, order_data.ticker, order_data.direction, order_data.qty)
+
+    if total_available_qty == 0:
+        db_order.status = OrderStatus.CANCELLED  # или просто "CANCELED" если без Enum
+        await db.commit()
+        raise ValueError("Нет подходящих лимитных ордеров для исполнения рыночной заявки")
+
+    # Новая проверка: суммарное доступное количество лимитных ордеров
+    if total_available_qty < order_data.qty:
+        db_order.status = OrderStatus.CANCELLED  # или просто "CANCELED" если без Enum
+        await db.commit()
+        raise ValueError(f"Недостаточно встречных лимитных ордеров: доступно {total_available_qty}, требуется {order_data.qty}")
+
+    balance_ticker = "RUB" if order_data.direction == "BUY" else order_data.ticker
+    # свободный остаток, а не весь amount: средства под стоящими ордерами уже заняты. Иначе
+    # отказ случился бы только при расчёте — после матчинга, с откатом и перечиткой стакана
+    balance = await get_available_balance(db, user_id, balance_ticker)
+
+    # Покупатель блокирует ровно стоимость выкупа: каждая сделка снимет блокировку по своей цене
+    required_amount = cost if order_data.direction == "BUY" else order_data.qty
+    if balance < required_amount:
+        db_order.status = OrderStatus.CANCELLED  # или просто "CANCELED" если без Enum
+        await db.commit()
+        raise ValueError(f"Недостаточно {balance_ticker} (требуется примерно {required_amount}, доступно {balance})")
+
+    # Блокировка, сделки и статус ордера коммитятся одной транзакцией; блокировка
+    # проверяется под тем же захватом строк balances, что и расчёт по сделкам
+    settlement = await execute_market_order(db, db_order, reserve=required_amount)
+    await db.commit()
+    _publish(order_data.ticker, settlement)
+    return db_order
+
+
+
 async def process_market_order(db: AsyncSession, order_data: schemas.MarketOrderBody, user_id: str):
     try:
-        instrument = await get_instrument_by_ticker(db, order_data.ticker)
-        if not instrument:
-            raise ValueError(f"Инструмент {order_data.ticker} не найден")
-
-        opposite_side = OrderDirection.SELL if order_data.direction == "BUY" else OrderDirection.BUY
-        db_order = models.Order(
-            user_id=user_id,
-            direction=order_data.direction,
-            instrument_ticker=order_data.ticker,
-            qty=order_data.qty,
-            price=None,
-            type="MARKET",
-            status=OrderStatus.NEW,
-            filled=0
-        )
-        db.add(db_order)
-        await db.commit()  
-        await db.refresh(db_order)
-
-        stmt = (
-            select(Order)
-            .where(
-                and_(
-                    Order.instrument_ticker == order_data.ticker,
-                    Order.direction == opposite_side,
-                    Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]),
-                    Order.type == "LIMIT"
-                )
-            )
-            .order_by(Order.price.asc() if order_data.direction == "BUY" else Order.price.desc(), Order.timestamp)
+        # при дедлоке или конфликте версий balances транзакция и стакан откатываются и ордер проводится заново
+        return await run_with_retries(
+            db,
+            lambda: _process_market_order(db, order_data, user_id),
+            "process_market_order",
+            on_retry=lambda: rollback_book(db, order_data.ticker),
         )
-        result = await db.execute(stmt)
-        matching_orders = result.scalars().all()
-        if not matching_orders:
-            db_order.status = OrderStatus.CANCELLED  # или просто "CANCELED" если без Enum
-            await db.commit()
-            raise ValueError("Нет подходящих лимитных ордеров для исполнения рыночной заявки")
-
-        # Новая проверка: суммарное доступное количество лимитных ордеров
-        total_available_qty = sum(o.qty - o.filled for o in matching_orders)
-        if total_available_qty < order_data.qty:
-            db_order.status = OrderStatus.CANCELLED  # или просто "CANCELED" если без Enum
-            await db.commit()
-            raise ValueError(f"Недостаточно встречных лимитных ордеров: доступно {total_available_qty}, требуется {order_data.qty}")
-
-        balance_ticker = "RUB" if order_data.direction == "BUY" else order_data.ticker
-        balance = await get_user_balance(db, user_id, balance_ticker)
-
-        max_price = max(o.price for o in matching_orders) if order_data.direction == "BUY" else 0
-        required_amount = order_data.qty * max_price if order_data.direction == "BUY" else order_data.qty
-        if balance < required_amount:
-            db_order.status = OrderStatus.CANCELLED  # или просто "CANCELED" если без Enum
-            await db.commit()
-            raise ValueError(f"Недостаточно {balance_ticker} (требуется примерно {required_amount}, доступно {balance})")
-        
-        await lock_user_balance(db, user_id, balance_ticker, required_amount)
-    
-        await execute_market_order(db, db_order)
-        await db.commit()  
-        return db_order
-
     except Exception as e:
         await db.rollback()
-        await db.commit()
+        await rollback_book(db, order_data.ticker)
         raise ValueError(f"Ошибка исполнения рыночного ордера: {str(e)}")
 
 
+async def _process_limit_order(
+    db: AsyncSession,
+    order_data: schemas.LimitOrderBody,
+    user_id: str
+):
+    instrument = await get_instrument_by_ticker(db, order_data.ticker)
+    if not instrument:
+        raise ValueError(f"Инструмент {order_data.ticker} не найден")
+
+    balance_ticker = "RUB" if order_data.direction == "BUY" else order_data.ticker
+    required_amount = order_data.price * order_data.qty if order_data.direction == "BUY" else order_data.qty
+
+    # Быстрый отказ без блокировок; окончательная проверка — при расчёте, под блокировкой строк
+    if await get_available_balance(db, user_id, balance_ticker) < required_amount:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Недостаточно {balance_ticker} (требуется {required_amount})"
+        )
+
+    db_order = models.Order(
+        user_id=user_id,
+        direction=order_data.direction,
+        instrument_ticker=order_data.ticker,
+        qty=order_data.qty,
+        price=order_data.price,
+        type="LIMIT",
+        status="NEW",
+        filled=0
+    )
+
+    db.add(db_order)
+    await db.flush()
+    # В режиме аукциона ордер просто встаёт в стакан и ждёт ближайшего раунда
+    settlement = await execute_limit_order(
+        db, db_order, match=not is_auction(order_data.ticker), reserve=required_amount
+    )
+    await db.commit()
+    await db.refresh(db_order)
+    rest_order(db_order)
+    _publish(order_data.ticker, settlement)
+    return db_order
+
+
+
 async def process_limit_order(
     db: AsyncSession,
     order_data: schemas.LimitOrderBody,
     user_id: str
 ):
     try:
-        instrument = await get_instrument_by_ticker(db, order_data.ticker)
-        if not instrument:
-            raise ValueError(f"Инструмент {order_data.ticker} не найден")
-
-        balance_ticker = "RUB" if order_data.direction == "BUY" else order_data.ticker
-        required_amount = order_data.price * order_data.qty if order_data.direction == "BUY" else order_data.qty
-
-        bal = await ensure_and_lock_balance(db, user_id, balance_ticker, required_amount)
-        await db.refresh(bal)
-
-        db_order = models.Order(
-            user_id=user_id,
-            direction=order_data.direction,
-            instrument_ticker=order_data.ticker,
-            qty=order_data.qty,
-            price=order_data.price,
-            type="LIMIT",
-            status="NEW",
-            filled=0
+        return await run_with_retries(
+            db,
+            lambda: _process_limit_order(db, order_data, user_id),
+            "process_limit_order",
+            on_retry=lambda: rollback_book(db, order_data.ticker),
         )
+    except Exception as e:
+        await db.rollback()
+        await rollback_book(db, order_data.ticker)
+        raise ValueError(f"Ошибка при создании лимитного ордера: {str(e)}")
 
-        db.add(db_order)
-        await db.flush()
-        await execute_limit_order(db, db_order)
-        await db.commit()
-        await db.refresh(db_order)
-        return db_order
 
-    except Exception as e:
+async def _process_auction(db: AsyncSession, ticker: str):
+    settlement = await execute_auction(db, ticker)
+    await db.commit()
+    _publish(ticker, settlement)
+    return settlement
+
+
+async def process_auction(db: AsyncSession, ticker: str):
+    try:
+        return await run_with_retries(
+            db,
+            lambda: _process_auction(db, ticker),
+            "process_auction",
+            on_retry=lambda: rollback_book(db, ticker),
+        )
+    except Exception:
         await db.rollback()
-        raise ValueError(f"Ошибка при создании лимитного ордера: {str(e)}")
\ No newline at end of file
+        await rollback_book(db, ticker)
+        raise
+
+
+async def _cancel_user_order(db: AsyncSession, order_id: str, user_id: str):
+    order = await get_order_by_id(db, order_id, user_id)
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+
+    if order.status not in [OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cannot cancel order with status {order.status.value}"
+        )
+    if order.type == OrderType.LIMIT:
+        if order.direction.value == "BUY":
+            balance_ticker = "RUB"
+            locked_amount = order.price * (order.qty - order.filled)
+        else:
+            balance_ticker = order.instrument_ticker
+            locked_amount = order.qty - order.filled
+        await release_balance(db, user_id, balance_ticker, locked_amount)
+        await apply_level_deltas(db, {
+            (order.instrument_ticker, order.direction.value, order.price): (-(order.qty - order.filled), -1)
+        })
+
+    order.status = OrderStatus.CANCELLED
+    await db.commit()
+    unrest_order(order.instrument_ticker, order.id)
+    publish_book(order.instrument_ticker)
+    return order
+
+
+async def cancel_user_order(db: AsyncSession, order_id: str, user_id: str):
+    return await run_with_retries(db, lambda: _cancel_user_order(db, order_id, user_id), "cancel_user_order")
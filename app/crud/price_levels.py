@@ -0,0 +1,107 @@
+from typing import Dict, List, Tuple
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..models import Order, OrderDirection, OrderStatus, OrderType, PriceLevel
+
+# (тикер, направление, цена) -> (изменение остатка, изменение числа ордеров)
+LevelKey = Tuple[str, str, int]
+LevelDeltas = Dict[LevelKey, Tuple[int, int]]
+
+_UPSERT_LEVEL_DELTAS = text("""
+    INSERT INTO price_levels (ticker, direction, price, total_qty, order_count)
+    SELECT d.ticker, CAST(d.direction AS order_direction_enum), d.price, d.total_qty, d.order_count
+    FROM unnest(
+        CAST(:tickers AS varchar[]),
+        CAST(:directions AS varchar[]),
+        CAST(:prices AS integer[]),
+        CAST(:total_qty AS integer[]),
+        CAST(:order_count AS integer[])
+    ) AS d(ticker, direction, price, total_qty, order_count)
+    ORDER BY d.ticker, d.direction, d.price
+    ON CONFLICT (ticker, direction, price) DO UPDATE
+    SET total_qty = price_levels.total_qty + excluded.total_qty,
+        order_count = price_levels.order_count + excluded.order_count
+""")
+
+_DELETE_EMPTY_LEVELS = text("""
+    DELETE FROM price_levels AS p
+    USING unnest(
+        CAST(:tickers AS varchar[]),
+        CAST(:directions AS varchar[]),
+        CAST(:prices AS integer[])
+    ) AS d(ticker, direction, price)
+    WHERE p.ticker = d.ticker
+      AND p.direction = CAST(d.direction AS order_direction_enum)
+      AND p.price = d.price
+      AND p.order_count <= 0
+""")
+
+
+def add_level_delta(deltas: LevelDeltas, key: LevelKey, qty: int, count: int) -> None:
+    total_qty, order_count = deltas.get(key, (0, 0))
+    deltas[key] = (total_qty + qty, order_count + count)
+
+
+async def apply_level_deltas(db: AsyncSession, deltas: LevelDeltas) -> None:
+    """
+    Применяет изменения уровней стакана в текущей транзакции: один upsert на все уровни
+    (строки захватываются в порядке ключа) и удаление опустевших.
+    """
+    keys = sorted(key for key, delta in deltas.items() if delta != (0, 0))
+    if not keys:
+        return
+
+    params = {
+        "tickers": [ticker for ticker, _, _ in keys],
+        "directions": [direction for _, direction, _ in keys],
+        "prices": [price for _, _, price in keys],
+    }
+    await db.execute(_UPSERT_LEVEL_DELTAS, {
+        **params,
+        "total_qty": [deltas[key][0] for key in keys],
+        "order_count": [deltas[key][1] for key in keys],
+    })
+    if any(deltas[key][1] < 0 for key in keys):
+        await db.execute(_DELETE_EMPTY_LEVELS, params)
+
+
+async def release_user_levels(db: AsyncSession, user_id) -> None:
+    """Снимает с уровней все открытые лимитные ордера пользователя (перед их массовой отменой)."""
+    result = await db.execute(
+        select(
+            Order.instrument_ticker,
+            Order.direction,
+            Order.price,
+            func.sum(Order.qty - Order.filled),
+            func.count(),
+        )
+        .where(
+            Order.user_id == user_id,
+            Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]),
+            Order.type == OrderType.LIMIT,
+        )
+        .group_by(Order.instrument_ticker, Order.direction, Order.price)
+    )
+    await apply_level_deltas(db, {
+        (ticker, direction.value, price): (-int(qty), -count)
+        for ticker, direction, price, qty, count in result
+    })
+
+
+def price_levels_stmt(ticker: str, direction: OrderDirection, limit: int):
+    return (
+        select(PriceLevel.price, PriceLevel.total_qty)
+        .where(
+            PriceLevel.ticker == ticker,
+            PriceLevel.direction == direction,
+            PriceLevel.total_qty > 0,
+        )
+        .order_by(PriceLevel.price.desc() if direction == OrderDirection.BUY else PriceLevel.price.asc())
+        .limit(limit)
+    )
+
+
+async def get_price_levels(db: AsyncSession, ticker: str, direction: OrderDirection, limit: int) -> List[Tuple[int, int]]:
+    """Первые limit уровней стороны — диапазонное чтение по первичному ключу."""
+    result = await db.execute(price_levels_stmt(ticker, direction, limit))
+    return [(price, int(qty)) for price, qty in result]
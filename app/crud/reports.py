@@ -3,7 +3,7 @@ import boto3
 import os
 import csv
 import io
-from datetime import datetime, date
+from datetime import datetime, timezone
 from typing import List, Dict, Any
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_
@@ -32,11 +32,12 @@ async def get_user_trades_for_month(
     month: int
 ) -> List[Dict[str, Any]]:
 
-    start_date = date(year, month, 1)
+    # Границы в UTC совпадают с границами месячных партиций transactions — читается ровно одна
+    start_date = datetime(year, month, 1, tzinfo=timezone.utc)
     if month == 12:
-        end_date = date(year + 1, 1, 1)
+        end_date = datetime(year + 1, 1, 1, tzinfo=timezone.utc)
     else:
-        end_date = date(year, month + 1, 1)
+        end_date = datetime(year, month + 1, 1, tzinfo=timezone.utc)
     
     buyer_trades_query = (
         select(
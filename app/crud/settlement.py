@@ -0,0 +1,117 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+from sqlalchemy import bindparam, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..engine import RestingOrder
+from ..models import Order, OrderStatus
+from .balance_access import BalanceKey, apply_balance_deltas, balance_key
+from .price_levels import LevelDeltas, add_level_delta, apply_level_deltas
+from .transactions import insert_transactions
+
+orders_table = Order.__table__
+
+
+def _as_uuid(value) -> UUID:
+    return value if isinstance(value, UUID) else UUID(str(value))
+
+
+@dataclass
+class StagedTrade:
+    buy_order_id: UUID
+    sell_order_id: UUID
+    buyer_id: UUID
+    seller_id: UUID
+    qty: int
+    price: int
+    # цена, по которой у покупателя были заблокированы средства под эту сделку
+    buyer_locked_price: int
+
+
+class Settlement:
+    """
+    Результат матчинга одного входящего ордера: сделки, новые остатки встречных ордеров
+    и изменения уровней стакана (price_levels). Копится в памяти и пишется в БД одним flush(); коммит остаётся за вызывающим кодом.
+    """
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.trades: List[StagedTrade] = []
+        self.order_fills: Dict[UUID, Tuple[int, OrderStatus]] = {}
+        self.level_deltas: LevelDeltas = {}
+        self.closed_orders: Set[UUID] = set()
+        # блокировка под входящий ордер: ставится вместе с расчётом, одной блокировкой строк
+        self.reservations: Dict[BalanceKey, int] = {}
+        # время расчёта: одно на сделки в БД, свечи и последнюю сделку /ticker
+        self.timestamp: Optional[datetime] = None
+
+    def reserve(self, user_id, ticker: str, amount: int) -> None:
+        key = balance_key(user_id, ticker)
+        self.reservations[key] = self.reservations.get(key, 0) + amount
+
+    def add_trade(self, trade: StagedTrade) -> None:
+        self.trades.append(trade)
+
+    def set_filled(self, order_id: UUID, qty: int, filled: int) -> None:
+        status = OrderStatus.EXECUTED if filled == qty else OrderStatus.PARTIALLY_EXECUTED
+        self.order_fills[order_id] = (filled, status)
+
+    def change_level(self, direction: str, price: int, qty: int, count: int) -> None:
+        add_level_delta(self.level_deltas, (self.ticker, direction, price), qty, count)
+
+    def fill_order(self, order: RestingOrder, qty: int) -> None:
+        """Сделка на qty по ордеру из стакана; order.filled её уже учитывает."""
+        self.set_filled(order.id, order.qty, order.filled)
+        closed = order.remaining == 0 and order.id not in self.closed_orders
+        if closed:
+            self.closed_orders.add(order.id)
+        self.change_level(order.direction, order.price, -qty, -1 if closed else 0)
+
+    def balance_deltas(self) -> Dict[BalanceKey, Tuple[int, int]]:
+        """Суммарные изменения (amount, locked) по каждому счёту за все сделки ордера."""
+        deltas = defaultdict(lambda: [0, 0])
+        for trade in self.trades:
+            buyer_id = _as_uuid(trade.buyer_id)
+            seller_id = _as_uuid(trade.seller_id)
+            total_cost = trade.price * trade.qty
+
+            buyer_rub = deltas[(buyer_id, "RUB")]
+            buyer_rub[0] -= total_cost
+            buyer_rub[1] -= trade.buyer_locked_price * trade.qty
+
+            deltas[(buyer_id, self.ticker)][0] += trade.qty
+
+            seller_asset = deltas[(seller_id, self.ticker)]
+            seller_asset[0] -= trade.qty
+            seller_asset[1] -= trade.qty
+
+            deltas[(seller_id, "RUB")][0] += total_cost
+        for key, amount in self.reservations.items():
+            deltas[key][1] += amount
+        return {key: (amount, locked) for key, (amount, locked) in deltas.items()}
+
+    async def flush(self, db: AsyncSession) -> None:
+        await db.flush()
+        await apply_balance_deltas(db, self.balance_deltas(), self.reservations)
+        await apply_level_deltas(db, self.level_deltas)
+
+        self.timestamp = datetime.now(timezone.utc)
+        await insert_transactions(db, self.ticker, [
+            (trade.buy_order_id, trade.sell_order_id, trade.qty, trade.price)
+            for trade in self.trades
+        ], self.timestamp)
+
+        if self.order_fills:
+            await db.execute(
+                update(orders_table)
+                .where(orders_table.c.id == bindparam("order_id"))
+                .values(filled=bindparam("new_filled"), status=bindparam("new_status")),
+                [
+                    {"order_id": order_id, "new_filled": filled, "new_status": status}
+                    for order_id, (filled, status) in self.order_fills.items()
+                ],
+            )
+
+        await db.flush()
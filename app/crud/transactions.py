@@ -1,41 +1,96 @@
-from sqlalchemy import select
+import base64
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+from uuid import UUID, uuid4
+from sqlalchemy import and_, insert, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from .. import models
 
+# С какого числа сделок одного ордера писать их через COPY, а не одним INSERT
+TRANSACTIONS_COPY_THRESHOLD = int(os.getenv("TRANSACTIONS_COPY_THRESHOLD", "500"))
 
-async def get_transactions(db: AsyncSession, ticker: str, limit: int = 10):
-    result = await db.execute(
-        select(models.Transaction).where(
-            models.Transaction.ticker == ticker
-        )
-        .limit(limit)
-    )
-    return result.scalars().all()
+TRANSACTION_COLUMNS = ("id", "ticker", "qty", "price", "timestamp", "buy_order_id", "sell_order_id")
+
+TradeCursor = Tuple[datetime, UUID]
+
+
+def encode_cursor(timestamp: datetime, id_: UUID) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{id_}".encode()).decode()
 
 
-async def create_transaction(
-    order: models.Order,
-    opposite_order: models.Order,
-    qty: int,
-    price: int,  
-    db: AsyncSession
+def decode_cursor(cursor: str) -> TradeCursor:
+    try:
+        timestamp, id_ = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), UUID(id_)
+    except ValueError:
+        raise ValueError("Некорректный курсор")
+
+
+async def get_transactions(
+    db: AsyncSession,
+    ticker: str,
+    limit: int = 10,
+    before: Optional[TradeCursor] = None,
+    after: Optional[TradeCursor] = None,
 ):
-    if order.direction == models.OrderDirection.BUY:
-        buyer_order = order
-        seller_order = opposite_order
-    else:
-        buyer_order = opposite_order
-        seller_order = order
-
-    transaction = models.Transaction(
-        ticker=order.instrument_ticker,
-        qty=qty,
-        price=price,  
-        buy_order_id=buyer_order.id,
-        sell_order_id=seller_order.id,
-    )
+    """
+    Сделки по тикеру от новых к старым, строками (id, qty, price, timestamp).
+    before — только старше курсора, after — только новее (ближайшие к курсору).
+    Порядок (timestamp, id) совпадает с индексом idx_transactions_ticker_time.
+    """
+    t = models.Transaction
+    stmt = select(t.id, t.qty, t.price, t.timestamp).where(t.ticker == ticker)
+    if before is not None:
+        timestamp, id_ = before
+        stmt = stmt.where(or_(t.timestamp < timestamp, and_(t.timestamp == timestamp, t.id < id_)))
+    if after is not None:
+        timestamp, id_ = after
+        stmt = stmt.where(or_(t.timestamp > timestamp, and_(t.timestamp == timestamp, t.id > id_)))
+
+    if after is not None and before is None:
+        # идём от курсора вперёд по времени, а отдаём всё равно от новых к старым
+        stmt = stmt.order_by(t.timestamp.asc(), t.id.asc()).limit(limit)
+        return list(reversed((await db.execute(stmt)).all()))
 
-    db.add(transaction)
-    await db.flush()
-    await db.commit()
-    await db.refresh(transaction)
\ No newline at end of file
+    stmt = stmt.order_by(t.timestamp.desc(), t.id.desc()).limit(limit)
+    return (await db.execute(stmt)).all()
+
+
+def trade_timestamp(timestamp: datetime, index: int) -> datetime:
+    """Время index-й сделки расчёта: сдвиг на микросекунду сохраняет порядок исполнения в ленте."""
+    return timestamp + timedelta(microseconds=index)
+
+
+async def insert_transactions(
+    db: AsyncSession,
+    ticker: str,
+    trades: List[tuple],
+    timestamp: Optional[datetime] = None,
+) -> None:
+    """
+    Пишет все сделки одного ордера за один запрос: trades — кортежи
+    (buy_order_id, sell_order_id, qty, price). id и время создаются на клиенте,
+    перечитывать строки не нужно. timestamp — время расчёта, от него считается
+    время каждой сделки (см. trade_timestamp).
+    """
+    if not trades:
+        return
+    timestamp = timestamp or datetime.now(timezone.utc)
+    records = [
+        (uuid4(), ticker, qty, price, trade_timestamp(timestamp, i), buy_order_id, sell_order_id)
+        for i, (buy_order_id, sell_order_id, qty, price) in enumerate(trades)
+    ]
+
+    if len(records) >= TRANSACTIONS_COPY_THRESHOLD:
+        # большие проходы по стакану — через COPY на том же соединении, внутри той же транзакции
+        connection = await db.connection()
+        raw = await connection.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            "transactions", records=records, columns=TRANSACTION_COLUMNS
+        )
+        return
+
+    await db.execute(
+        insert(models.Transaction.__table__).values([dict(zip(TRANSACTION_COLUMNS, r)) for r in records])
+    )
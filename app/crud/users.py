@@ -5,6 +5,9 @@ from .. import models
 from ..schemas import NewUser,OrderStatus
 from sqlalchemy import delete
 from uuid import uuid4
+from .price_levels import release_user_levels
+from .ledger import delete_user_ledger
+from .balance_access import lock_user_balances
 
 async def get_user_by_token(db: AsyncSession, token: str):
     result = await db.execute(
@@ -23,6 +26,9 @@ async def register_user(db: AsyncSession, user_data: NewUser):
 
 
 async def delete_user_all_data(user_id: str, db: AsyncSession) -> None:
+    # порядок блокировок как у расчёта сделки: balances, затем price_levels и orders
+    await lock_user_balances(db, user_id)
+    await release_user_levels(db, user_id)
     await db.execute(
         update(models.Order)
         .where(
@@ -33,6 +39,7 @@ async def delete_user_all_data(user_id: str, db: AsyncSession) -> None:
     )
 
 
+    await delete_user_ledger(db, user_id)
     await db.execute(
         delete(models.Balance).where(models.Balance.user_id == user_id)
     )
\ No newline at end of file
@@ -1,14 +1,27 @@
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from uuid import UUID
 from .. import schemas, models, crud
 from ..database import get_db
 from ..dependencies.user import get_authenticated_user, get_target_user_by_id_or_404
 from ..dependencies.instruments import get_instrument_by_ticker_or_404
+from ..crud.balance_access import forget_balances, run_with_retries
+from ..engine import BOOKS, drop_book, drop_user_orders, forget_ticker, submit_waiting, touch_book
 
 
 router = APIRouter()
 
+
+# Стаканы меняются только в очереди актора тикера, чтобы не разойтись с идущим матчингом
+async def _drop_book_job(db: AsyncSession, ticker: str) -> None:
+    drop_book(ticker)
+
+
+async def _drop_user_orders_job(db: AsyncSession, ticker: str, user_id: UUID) -> None:
+    drop_user_orders(ticker, user_id)
+
+
 @router.post("/instrument", response_model=schemas.Ok)
 async def add_instrument(
     instrument: schemas.Instrument,
@@ -23,6 +36,8 @@ async def add_instrument(
         raise HTTPException(status_code=400, detail="Инструмент уже существует")
 
     await crud.create_instrument(db, instrument)
+    # в кэше мог остаться пустой стакан тикера с тем же именем
+    touch_book(instrument.ticker)
     
     return schemas.Ok(success=True)
 
@@ -73,6 +88,22 @@ async def withdraw_from_balance(
     return schemas.Ok(success=True)
 
 
+@router.post("/balance/batch", response_model=schemas.BalanceBatchResponse)
+async def batch_balance(
+    batch: schemas.BalanceBatchRequest,
+    current_user: models.User = Depends(get_authenticated_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if current_user.role != "ADMIN":
+        raise HTTPException(status_code=403, detail="Требуются права администратора")
+
+    errors = await crud.apply_balance_batch(db, batch.operations)
+
+    return schemas.BalanceBatchResponse(results=[
+        schemas.BalanceBatchResult(success=error is None, error=error) for error in errors
+    ])
+
+
 @router.delete("/instrument/{ticker}", response_model=schemas.Ok)
 async def delete_instrument(
     ticker: str,
@@ -85,6 +116,10 @@ async def delete_instrument(
     instrument = await get_instrument_by_ticker_or_404(ticker, db)
     await db.delete(instrument)
     await db.commit()
+    await submit_waiting(ticker, _drop_book_job, ticker)
+    forget_ticker(ticker)
+    # балансы по инструменту удалены каскадом
+    forget_balances()
 
     return schemas.Ok(success=True)
 
@@ -98,8 +133,17 @@ async def delete_user(
     if current_user.role != "ADMIN":
         raise HTTPException(status_code=403, detail="Требуются права администратора")
 
-    await crud.delete_user_all_data(user.id, db)
-    await db.delete(user)
-    await db.commit()
+    # ответ и id собираются заранее: после отката при повторе объект user просрочен
+    deleted = schemas.User.model_validate(user)
+    user_id = user.id
+
+    async def operation():
+        await crud.delete_user_all_data(user_id, db)
+        await db.execute(delete(models.User).where(models.User.id == user_id))
+        await db.commit()
+
+    await run_with_retries(db, operation, "delete_user")
+    for ticker in list(BOOKS):
+        await submit_waiting(ticker, _drop_user_orders_job, ticker, user_id)
 
-    return user
+    return deleted
@@ -1,17 +1,46 @@
-from fastapi import APIRouter, Depends
+import json
+import os
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import Response
 from typing import Dict
-from sqlalchemy.ext.asyncio import AsyncSession
-from ..database import get_db
+from ..database import AsyncSessionLocal
 from .. import crud
 from .. import models
+from ..cache import ResponseCache, etag_matches
+from ..crud.balance_access import balance_version
 from ..dependencies.user import get_authenticated_user
 
+# Версия баланса растёт после каждого коммита, менявшего его в этом процессе. Балансы меняют
+# и другие процессы (воркеры, скрипты, прямые правки в БД) при любом движке стакана,
+# поэтому ответ всегда живёт не дольше BALANCE_CACHE_TTL секунд.
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "0.5"))
+BALANCE_CACHE = ResponseCache(
+    ttl=BALANCE_CACHE_TTL,
+    max_entries=int(os.getenv("BALANCE_CACHE_SIZE", "10000")),
+)
+
 router = APIRouter()
+
+
+async def _balance_body(user_id: str) -> bytes:
+    # своя сессия: вычислением пользуются все ждущие запросы, а не только первый
+    async with AsyncSessionLocal() as db:
+        balances = await crud.get_user_balances(db, user_id)
+    return json.dumps({ticker: amount for ticker, amount in balances}).encode()
+
+
 @router.get("/balance", response_model=Dict[str, int])
 async def get_user_balances(
+    request: Request,
     current_user: models.User = Depends(get_authenticated_user),
-    db: AsyncSession = Depends(get_db)
 ):
-    balances = await crud.get_user_balances(db, str(current_user.id))
+    user_id = str(current_user.id)
+    body, etag = await BALANCE_CACHE.get(
+        user_id,
+        balance_version(user_id),
+        lambda: _balance_body(user_id),
+    )
 
-    return {ticker: amount for ticker, amount in balances}
\ No newline at end of file
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
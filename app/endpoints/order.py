@@ -1,10 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException, Header
 from sqlalchemy.ext.asyncio import AsyncSession
 from uuid import UUID
-from sqlalchemy import select, update
 from typing import List, Union
 from ..database import get_db
-from ..models import User, OrderStatus, Balance
+from ..models import User
 import logging
 from ..schemas import CreateOrderResponse, LimitOrder, MarketOrder, LimitOrderBody, MarketOrderBody, Ok
 from ..dependencies.user import get_authenticated_user
@@ -12,12 +11,11 @@ from ..crud import get_orders_by_user_id
 from ..crud import (
     process_market_order,
     process_limit_order,
-    unlock_user_balance
 )
-from app.models import OrderType
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
-from ..crud.orders import get_order_by_id as crud_get_order_by_id
+from ..crud.orders import get_order_by_id as crud_get_order_by_id, cancel_user_order
+from ..engine import MatchingQueueFull, submit
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -29,13 +27,13 @@ async def create_order(
     db: AsyncSession = Depends(get_db)
 ):
     try:
-        if isinstance(order, LimitOrderBody):
-            result = await process_limit_order(db, order, str(current_user.id))
-        else:
-            result = await process_market_order(db, order, str(current_user.id))
-            
+        job = process_limit_order if isinstance(order, LimitOrderBody) else process_market_order
+        result = await submit(order.ticker, job, order, str(current_user.id))
+
         return {"success": True, "order_id": str(result.id)}
-        
+
+    except MatchingQueueFull:
+        raise HTTPException(status_code=503, detail="Сервер перегружен, попробуйте позже")
     except ValueError as e:
         raise HTTPException(status_code=422, detail=str(e)) 
     except Exception as e:
@@ -95,52 +93,16 @@ async def cancel_order(
         order = await crud_get_order_by_id(db, order_id, str(current_user.id))
         if not order:
             raise HTTPException(status_code=404, detail="Order not found")
-        
-        if order.status not in [OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Cannot cancel order with status {order.status.value}"
-            )
-        if order.type == OrderType.LIMIT:
-            if order.direction.value == "BUY":
-                balance_ticker = "RUB"
-                locked_amount = order.price * (order.qty - order.filled)
-            else:
-                balance_ticker = order.instrument_ticker
-                locked_amount = order.qty - order.filled
-            current_balance = await db.execute(
-                select(Balance)
-                .where(
-                    Balance.user_id == str(current_user.id),
-                    Balance.instrument_ticker == balance_ticker
-                )
-                .with_for_update()
-            )
-            current_balance = current_balance.scalar_one_or_none()
-            
-            if not current_balance:
-                raise HTTPException(status_code=400, detail="Balance not found")
 
-            if current_balance.locked < locked_amount:
-                raise HTTPException(status_code=400, detail="Not enough locked balance")
+        await submit(order.instrument_ticker, cancel_user_order, order_id, str(current_user.id))
 
-            await db.execute(
-                update(Balance)
-                .where(
-                    Balance.user_id == str(current_user.id),
-                    Balance.instrument_ticker == balance_ticker
-                )
-                .values(locked=Balance.locked - locked_amount)
-            )
-        
-        order.status = OrderStatus.CANCELLED
-        await db.commit()
-        
         return Ok()
-        
+
+    except MatchingQueueFull:
+        raise HTTPException(status_code=503, detail="Сервер перегружен, попробуйте позже")
     except HTTPException:
         raise
     except Exception as e:
-        await db.rollback()
         logger.error(f"Error cancelling order: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Internal server error")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Internal server error")
+
@@ -1,13 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import json
+import os
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 from .. import crud
 from ..crud import get_instruments, get_transactions, get_instrument_by_ticker
+from ..crud.candles import get_candles
+from ..crud.transactions import decode_cursor, encode_cursor
 from ..schemas import User as UserSchema, NewUser, Instrument, Transaction
 from ..crud import register_user as register_user_crud
-from ..database import get_db
-from ..schemas import L2OrderBook
-from fastapi.responses import JSONResponse
+from ..database import AsyncSessionLocal, get_db
+from ..schemas import Candle, L2OrderBook, TickerInfo
+from ..engine import BOOKS, FEED_HEARTBEAT, IN_MEMORY, INTERVALS, book_version, subscribe, unsubscribe
+from ..cache import ResponseCache, etag_matches
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import Query
 import logging
 
@@ -15,6 +23,14 @@ import logging
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# В режиме memory версия стакана точная и срок жизни не нужен. В режиме sql версию
+# двигают только заявки этого процесса, поэтому ответ живёт не дольше ORDERBOOK_CACHE_TTL секунд.
+ORDERBOOK_CACHE_TTL = float(os.getenv("ORDERBOOK_CACHE_TTL", "0.05"))
+ORDERBOOK_CACHE = ResponseCache(
+    ttl=None if IN_MEMORY else ORDERBOOK_CACHE_TTL,
+    max_entries=int(os.getenv("ORDERBOOK_CACHE_SIZE", "1024")),
+)
+
 
 @router.post("/register", response_model=UserSchema)
 async def register_user(request: NewUser, db: AsyncSession = Depends(get_db)):
@@ -33,23 +49,35 @@ async def list_instruments(db: AsyncSession = Depends(get_db)):
         )
 
 
+async def _orderbook_body(ticker: str, limit: int) -> bytes:
+    # стакан есть в памяти — значит, инструмент существует (drop_book убирает его при удалении)
+    orderbook = crud.get_memory_orderbook(ticker, limit)
+    if orderbook is None:
+        # своя сессия: вычислением пользуются все ждущие запросы, а сессия запроса
+        # закрывается вместе с ним, даже если вычисление ещё идёт
+        async with AsyncSessionLocal() as db:
+            instrument = await get_instrument_by_ticker(db, ticker)
+            if not instrument:
+                raise HTTPException(status_code=404, detail="Инструмент не найден")
+
+            orderbook = await crud.get_orderbook_data(db, ticker, limit)
+        if orderbook is None:
+            orderbook = L2OrderBook(bid_levels=[], ask_levels=[])
+    return orderbook.model_dump_json().encode()
+
+
 @router.get("/orderbook/{ticker}", response_model=L2OrderBook)
 async def get_orderbook(
     ticker: str,
+    request: Request,
     limit: int = Query(10, gt=0),
-    db: AsyncSession = Depends(get_db)
 ):
     try:
-        instrument = await get_instrument_by_ticker(db, ticker)
-        if not instrument:
-            raise HTTPException(status_code=404, detail="Инструмент не найден")
-        
-        orderbook = await crud.get_orderbook_data(db, ticker, limit)
-
-        if orderbook is None:
-            return L2OrderBook(bid_levels=[], ask_levels=[])
-
-        return orderbook
+        body, etag = await ORDERBOOK_CACHE.get(
+            (ticker, limit),
+            book_version(ticker),
+            lambda: _orderbook_body(ticker, limit),
+        )
     except HTTPException as e:
         raise e  # <-- пробрасываем как есть, не превращаем в 500
     except ValueError as e:
@@ -64,25 +92,113 @@ async def get_orderbook(
             detail="Внутренняя ошибка сервера"
         )
 
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+@router.get("/ticker", response_model=List[TickerInfo])
+async def get_tickers(
+    tickers: str = Query(..., description="Тикеры через запятую"),
+    db: AsyncSession = Depends(get_db)
+):
+    result = []
+    for ticker in dict.fromkeys(t.strip() for t in tickers.split(",") if t.strip()):
+        info = await crud.get_ticker_info(db, ticker)
+        # по неизвестным тикерам и тикерам без торгов отдаём пустую строку, без 404
+        result.append(info or TickerInfo(ticker=ticker))
+    return result
+
+
+@router.get("/ticker/{ticker}", response_model=TickerInfo)
+async def get_ticker(ticker: str, db: AsyncSession = Depends(get_db)):
+    info = await crud.get_ticker_info(db, ticker)
+    if info is not None:
+        return info
+    instrument = await get_instrument_by_ticker(db, ticker)
+    if not instrument:
+        raise HTTPException(status_code=404, detail="Инструмент не найден")
+    return TickerInfo(ticker=ticker)
+
+
+@router.get("/candles/{ticker}", response_model=List[Candle])
+async def get_ticker_candles(
+    ticker: str,
+    interval: str = Query("1m", description="1m, 5m, 1h или 1d"),
+    since: Optional[datetime] = Query(None, alias="from"),
+    until: Optional[datetime] = Query(None, alias="to"),
+    limit: int = Query(500, gt=0, le=5000),
+    db: AsyncSession = Depends(get_db)
+):
+    if interval not in INTERVALS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный интервал {interval}, доступны: {', '.join(INTERVALS)}")
+    return await get_candles(db, ticker, interval, since, until, limit)
+
+
+@router.get("/orderbook/{ticker}/stream")
+async def stream_orderbook(ticker: str, request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    SSE-поток стакана: сначала снапшот всех уровней, затем дельты с номером seq.
+    В дельте — новые суммарные объёмы изменившихся уровней (0 — уровень исчез).
+    Медленному клиенту изменения схлопываются, при переполнении буфера снова шлётся снапшот.
+    """
+    if not IN_MEMORY:
+        raise HTTPException(status_code=400, detail="Поток стакана доступен только при ORDERBOOK_ENGINE=memory")
+    if ticker not in BOOKS:
+        instrument = await get_instrument_by_ticker(db, ticker)
+        if not instrument:
+            raise HTTPException(status_code=404, detail="Инструмент не найден")
+    # соединение с БД потоку не нужно, не держим его до конца стрима
+    await db.close()
+
+    subscription = subscribe(ticker)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(subscription.next_message(), FEED_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"id: {message['seq']}\nevent: {message['type']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 
 @router.get("/transactions/{ticker}", response_model=List[Transaction])
 async def get_transactions_history(
     ticker: str,
+    response: Response,
     limit: int = Query(10, gt=0),
+    before: Optional[str] = Query(None, description="Курсор: сделки старше"),
+    after: Optional[str] = Query(None, description="Курсор: сделки новее"),
     db: AsyncSession = Depends(get_db)
 ):
     try:
-        transactions = await get_transactions(db, ticker, limit)
-        # Здесь мы пересчитываем amount вручную
-        return [
-            Transaction(
-                ticker=t.ticker,
-                amount=t.qty * t.price,  # <--- вот это ключевое
-                price=t.price,
-                timestamp=t.timestamp,
-            )
-            for t in transactions
-        ]
+        before_key = decode_cursor(before) if before else None
+        after_key = decode_cursor(after) if after else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        rows = await get_transactions(db, ticker, limit, before=before_key, after=after_key)
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Ошибка при получении транзакций: {str(e)}")
+
+    if rows:
+        # X-Next-Cursor — следующая страница (старше), X-Prev-Cursor — более новые сделки
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].timestamp, rows[-1].id)
+        response.headers["X-Prev-Cursor"] = encode_cursor(rows[0].timestamp, rows[0].id)
+    return [
+        Transaction(
+            ticker=ticker,
+            amount=qty * price,
+            price=price,
+            timestamp=timestamp,
+        )
+        for _, qty, price, timestamp in rows
+    ]
@@ -0,0 +1,71 @@
+from .actor import MatchingQueueFull, stop_actors, submit, submit_waiting
+from .auction import is_auction, start_auctions, stop_auctions
+from .feed import FEED_HEARTBEAT, subscribe, unsubscribe
+from .candles import INTERVALS, open_candle, record_candle_trade, start_candles, stop_candles
+from .book import BUY, SELL, BookView, Fill, OrderBook, RestingOrder, side_of
+from .registry import (
+    BOOKS,
+    IN_MEMORY,
+    add_book_listener,
+    book_version,
+    book_view,
+    drop_book,
+    drop_user_orders,
+    get_book,
+    load_books,
+    publish_book,
+    reload_book,
+    rest_order,
+    rollback_book,
+    touch_book,
+    unrest_order,
+)
+from .snapshot import restore_books, start_snapshots, stop_snapshots
+from .ticker import forget_ticker, load_last_trades, record_last_trade, ticker_snapshot
+
+__all__ = [
+    'MatchingQueueFull',
+    'stop_actors',
+    'submit',
+    'submit_waiting',
+    'is_auction',
+    'start_auctions',
+    'stop_auctions',
+    'INTERVALS',
+    'open_candle',
+    'record_candle_trade',
+    'start_candles',
+    'stop_candles',
+    'FEED_HEARTBEAT',
+    'subscribe',
+    'unsubscribe',
+    'BUY',
+    'SELL',
+    'BookView',
+    'Fill',
+    'OrderBook',
+    'RestingOrder',
+    'side_of',
+    'BOOKS',
+    'IN_MEMORY',
+    'add_book_listener',
+    'book_version',
+    'book_view',
+    'drop_book',
+    'drop_user_orders',
+    'get_book',
+    'load_books',
+    'publish_book',
+    'reload_book',
+    'rest_order',
+    'rollback_book',
+    'touch_book',
+    'unrest_order',
+    'restore_books',
+    'start_snapshots',
+    'stop_snapshots',
+    'forget_ticker',
+    'load_last_trades',
+    'record_last_trade',
+    'ticker_snapshot',
+]
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+from typing import Dict
+from ..database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+MATCHING_QUEUE_SIZE = int(os.getenv("MATCHING_QUEUE_SIZE", "1000"))
+# Сколько секунд простаивающий актор живёт без заявок
+MATCHING_IDLE_TIMEOUT = float(os.getenv("MATCHING_IDLE_TIMEOUT", "60"))
+
+
+class MatchingQueueFull(Exception):
+    pass
+
+
+class MatchingActor:
+    """
+    Единственный писатель по инструменту: все заявки и отмены по тикеру
+    выполняются по очереди в одной задаче, каждая — в своей сессии БД.
+    """
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.queue: asyncio.Queue = asyncio.Queue(MATCHING_QUEUE_SIZE)
+        self.task = asyncio.create_task(self._run(), name=f"matching-{ticker}")
+
+    async def submit(self, job, *args, wait: bool = False):
+        future = asyncio.get_running_loop().create_future()
+        if wait:
+            await self.queue.put((job, args, future))
+        else:
+            try:
+                self.queue.put_nowait((job, args, future))
+            except asyncio.QueueFull:
+                raise MatchingQueueFull(self.ticker)
+        return await future
+
+    def cancel_pending(self) -> None:
+        """Отменяет ожидание у всех заявок, оставшихся в очереди остановленного актора."""
+        while not self.queue.empty():
+            _, _, future = self.queue.get_nowait()
+            if not future.done():
+                future.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                job, args, future = await asyncio.wait_for(self.queue.get(), MATCHING_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if self.queue.empty():
+                    if ACTORS.get(self.ticker) is self:
+                        del ACTORS[self.ticker]
+                    return
+                continue
+
+            try:
+                async with AsyncSessionLocal() as db:
+                    result = await job(db, *args)
+            except asyncio.CancelledError:
+                # актор остановлен посреди заявки — ждущий её запрос не должен висеть
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.queue.task_done()
+
+
+ACTORS: Dict[str, MatchingActor] = {}
+
+
+async def submit(ticker: str, job, *args):
+    """Ставит job(db, *args) в очередь актора инструмента и ждёт результат."""
+    actor = ACTORS.get(ticker)
+    if actor is None:
+        actor = ACTORS[ticker] = MatchingActor(ticker)
+    return await actor.submit(job, *args)
+
+
+async def submit_waiting(ticker: str, job, *args):
+    """
+    Как submit, но при полной очереди ждёт места, а не отказывает: для изменений
+    стакана, которые уже закоммичены в БД и не могут быть отброшены.
+    """
+    actor = ACTORS.get(ticker)
+    if actor is None:
+        actor = ACTORS[ticker] = MatchingActor(ticker)
+    return await actor.submit(job, *args, wait=True)
+
+
+async def stop_actors() -> None:
+    actors = list(ACTORS.values())
+    ACTORS.clear()
+    for actor in actors:
+        actor.task.cancel()
+    await asyncio.gather(*(a.task for a in actors), return_exceptions=True)
+    for actor in actors:
+        actor.cancel_pending()
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List
+from .actor import MatchingQueueFull, submit
+from .registry import IN_MEMORY
+
+logger = logging.getLogger(__name__)
+
+AUCTION_INTERVAL = float(os.getenv("AUCTION_INTERVAL", "1.0"))
+
+
+def _parse_auction_tickers(value: str) -> Dict[str, float]:
+    """AUCTION_TICKERS=AAPL:0.5,TSLA — тикеры в режиме периодического аукциона и их интервал в секундах."""
+    intervals = {}
+    for item in value.split(","):
+        ticker, _, interval = item.strip().partition(":")
+        if ticker:
+            intervals[ticker] = float(interval) if interval else AUCTION_INTERVAL
+    return intervals
+
+
+AUCTION_TICKERS = _parse_auction_tickers(os.getenv("AUCTION_TICKERS", ""))
+if AUCTION_TICKERS and not IN_MEMORY:
+    logger.warning("AUCTION_TICKERS ignored: call auctions need ORDERBOOK_ENGINE=memory")
+    AUCTION_TICKERS = {}
+
+TASKS: List[asyncio.Task] = []
+
+
+def is_auction(ticker: str) -> bool:
+    return ticker in AUCTION_TICKERS
+
+
+async def _auction_loop(ticker: str, interval: float, job) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # аукцион идёт через очередь актора, как и обычные заявки по инструменту
+            await submit(ticker, job, ticker)
+        except MatchingQueueFull:
+            logger.warning("auction skipped: matching queue is full", extra={"ticker": ticker})
+        except Exception:
+            logger.exception("auction failed", extra={"ticker": ticker})
+
+
+def start_auctions(job) -> None:
+    """Запускает по таймеру job(db, ticker) для каждого инструмента в режиме аукциона."""
+    for ticker, interval in AUCTION_TICKERS.items():
+        TASKS.append(asyncio.create_task(_auction_loop(ticker, interval, job), name=f"auction-{ticker}"))
+
+
+async def stop_auctions() -> None:
+    for task in TASKS:
+        task.cancel()
+    await asyncio.gather(*TASKS, return_exceptions=True)
+    TASKS.clear()
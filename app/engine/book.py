@@ -0,0 +1,293 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from dataclasses import dataclass
+from itertools import accumulate, islice
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+from uuid import UUID
+
+BUY = "BUY"
+SELL = "SELL"
+
+
+def side_of(direction) -> str:
+    # direction приходит то как schemas.Direction, то как models.OrderDirection, то строкой
+    return getattr(direction, "value", direction)
+
+
+@dataclass
+class RestingOrder:
+    id: UUID
+    user_id: UUID
+    direction: str
+    price: int
+    qty: int
+    filled: int = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.qty - self.filled
+
+
+@dataclass
+class Fill:
+    order: RestingOrder
+    qty: int
+    price: int
+
+
+class PriceLevel:
+    __slots__ = ("price", "orders", "total_qty")
+
+    def __init__(self, price: int):
+        self.price = price
+        self.orders: Deque[RestingOrder] = deque()
+        self.total_qty = 0
+
+
+class OrderBook:
+    """
+    Стакан одного инструмента: уровни цен в отсортированных списках,
+    внутри уровня — FIFO-очередь ордеров (приоритет цена-время).
+    """
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.levels: Dict[str, Dict[int, PriceLevel]] = {BUY: {}, SELL: {}}
+        # цены по возрастанию: лучший бид — последний, лучший аск — первый
+        self.prices: Dict[str, List[int]] = {BUY: [], SELL: []}
+        self.orders: Dict[UUID, RestingOrder] = {}
+        # изменения с последней публикации: ("A", order), ("F", id, filled, side, price), ("D", id, side, price)
+        self.events: List[tuple] = []
+
+    def clear(self) -> None:
+        for side in (BUY, SELL):
+            self.levels[side].clear()
+            self.prices[side].clear()
+        self.orders.clear()
+        self.events.clear()
+
+    def add(self, order: RestingOrder) -> None:
+        if order.id in self.orders or order.remaining <= 0:
+            return
+        levels = self.levels[order.direction]
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = PriceLevel(order.price)
+            insort(self.prices[order.direction], order.price)
+        level.orders.append(order)
+        level.total_qty += order.remaining
+        self.orders[order.id] = order
+        self.events.append(("A", order))
+
+    def remove(self, order_id: UUID) -> Optional[RestingOrder]:
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        level = self.levels[order.direction][order.price]
+        level.orders.remove(order)
+        level.total_qty -= order.remaining
+        if not level.orders:
+            self._drop_level(order.direction, order.price)
+        self.events.append(("D", order_id, order.direction, order.price))
+        return order
+
+    def set_filled(self, order_id: UUID, filled: int) -> None:
+        """Выставляет исполненный объём ордера, не меняя его места в очереди."""
+        order = self.orders.get(order_id)
+        if order is None:
+            return
+        self.levels[order.direction][order.price].total_qty -= filled - order.filled
+        order.filled = filled
+        self.events.append(("F", order_id, filled, order.direction, order.price))
+        if order.remaining <= 0:
+            self.remove(order_id)
+
+    def remove_user(self, user_id: UUID) -> List[RestingOrder]:
+        removed = [o for o in self.orders.values() if o.user_id == user_id]
+        for order in removed:
+            self.remove(order.id)
+        return removed
+
+    def _drop_level(self, side: str, price: int) -> None:
+        del self.levels[side][price]
+        prices = self.prices[side]
+        del prices[bisect_left(prices, price)]
+
+    def iter_levels(self, side: str) -> Iterator[PriceLevel]:
+        """Уровни стороны в порядке приоритета: биды по убыванию цены, аски по возрастанию."""
+        levels = self.levels[side]
+        prices = reversed(self.prices[side]) if side == BUY else iter(self.prices[side])
+        for price in prices:
+            yield levels[price]
+
+    def top_levels(self, side: str, limit: int) -> List[Tuple[int, int]]:
+        """L2: первые limit уровней стороны как (цена, суммарный остаток)."""
+        return [(level.price, level.total_qty) for level in islice(self.iter_levels(side), limit)]
+
+    def best_price(self, side: str) -> Optional[int]:
+        prices = self.prices[side]
+        if not prices:
+            return None
+        return prices[-1] if side == BUY else prices[0]
+
+    def depth_for(self, direction, qty: int) -> Tuple[int, int]:
+        """
+        Сколько объёма (не больше qty) возьмёт рыночный ордер и сколько это стоит.
+        Идёт только по агрегатам уровней, сами ордера не трогает.
+        """
+        opposite = SELL if side_of(direction) == BUY else BUY
+        available = cost = 0
+        for level in self.iter_levels(opposite):
+            take = min(level.total_qty, qty - available)
+            available += take
+            cost += take * level.price
+            if available == qty:
+                break
+        return available, cost
+
+    def match(self, direction, qty: int, limit_price: Optional[int] = None) -> List[Fill]:
+        """
+        Сводит входящий ордер с противоположной стороной стакана.
+        limit_price=None — рыночный ордер. Исполненные ордера сразу снимаются со стакана.
+        """
+        side = side_of(direction)
+        opposite = SELL if side == BUY else BUY
+        fills: List[Fill] = []
+        remaining = qty
+
+        while remaining > 0:
+            price = self.best_price(opposite)
+            if price is None:
+                break
+            if limit_price is not None:
+                if side == BUY and price > limit_price:
+                    break
+                if side == SELL and price < limit_price:
+                    break
+
+            level = self.levels[opposite][price]
+            while remaining > 0 and level.orders:
+                resting = level.orders[0]
+                trade_qty = min(remaining, resting.remaining)
+                resting.filled += trade_qty
+                level.total_qty -= trade_qty
+                remaining -= trade_qty
+                fills.append(Fill(resting, trade_qty, price))
+                self.events.append(("F", resting.id, resting.filled, opposite, price))
+                if resting.remaining == 0:
+                    level.orders.popleft()
+                    del self.orders[resting.id]
+
+            if not level.orders:
+                self._drop_level(opposite, price)
+
+        return fills
+
+    def clearing_price(self) -> Optional[Tuple[int, int]]:
+        """
+        Цена аукциона для пересечённого стакана и исполняемый по ней объём.
+        Выбирается цена с максимальным объёмом, при равенстве — с минимальным дисбалансом
+        спроса и предложения, среди оставшихся — средняя. None — стакан не пересечён.
+        """
+        best_bid, best_ask = self.best_price(BUY), self.best_price(SELL)
+        if best_bid is None or best_ask is None or best_bid < best_ask:
+            return None
+
+        bid_prices, ask_prices = self.prices[BUY], self.prices[SELL]
+        # bid_from[k] — объём бидов с ценой >= bid_prices[k], ask_upto[k] — асков с ценой <= ask_prices[k]
+        bid_from = list(accumulate(self.levels[BUY][p].total_qty for p in reversed(bid_prices)))[::-1]
+        ask_upto = list(accumulate(self.levels[SELL][p].total_qty for p in ask_prices))
+
+        candidates = sorted(
+            {p for p in bid_prices if p >= best_ask} | {p for p in ask_prices if p <= best_bid}
+        )
+        best_key, tied = None, []
+        for price in candidates:
+            k = bisect_left(bid_prices, price)
+            demand = bid_from[k] if k < len(bid_prices) else 0
+            m = bisect_right(ask_prices, price)
+            supply = ask_upto[m - 1] if m else 0
+            key = (min(demand, supply), -abs(demand - supply))
+            if best_key is None or key > best_key:
+                best_key, tied = key, [price]
+            elif key == best_key:
+                tied.append(price)
+
+        volume = best_key[0]
+        if volume == 0:
+            return None
+        return tied[len(tied) // 2], volume
+
+    def uncross(self, price: int, volume: int) -> List[Tuple[RestingOrder, RestingOrder, int]]:
+        """
+        Исполняет volume по единой цене price: биды с ценой не ниже и аски с ценой не выше,
+        каждая сторона — в порядке цена-время. Возвращает пары (покупка, продажа, объём).
+        """
+        bids = self.match(SELL, volume, price)
+        asks = self.match(BUY, volume, price)
+
+        trades = []
+        bid_iter, ask_iter = iter(bids), iter(asks)
+        bid, ask = next(bid_iter, None), next(ask_iter, None)
+        bid_left = bid.qty if bid else 0
+        ask_left = ask.qty if ask else 0
+        while bid and ask:
+            qty = min(bid_left, ask_left)
+            trades.append((bid.order, ask.order, qty))
+            bid_left -= qty
+            ask_left -= qty
+            if bid_left == 0:
+                bid = next(bid_iter, None)
+                bid_left = bid.qty if bid else 0
+            if ask_left == 0:
+                ask = next(ask_iter, None)
+                ask_left = ask.qty if ask else 0
+        return trades
+
+
+class BookView:
+    """
+    Уровни стакана на момент последней публикации, то есть последнего коммита.
+    Стакан OrderBook меняется матчингом ещё до коммита (и откатывается при ошибке),
+    поэтому L2, /ticker и снапшоты потока читают только это представление.
+    """
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.levels: Dict[str, Dict[int, int]] = {BUY: {}, SELL: {}}
+        self.prices: Dict[str, List[int]] = {BUY: [], SELL: []}
+
+    @classmethod
+    def of(cls, book: OrderBook) -> "BookView":
+        view = cls(book.ticker)
+        for side in (BUY, SELL):
+            view.prices[side] = list(book.prices[side])
+            view.levels[side] = {price: level.total_qty for price, level in book.levels[side].items()}
+        return view
+
+    def set_level(self, side: str, price: int, qty: int) -> None:
+        levels, prices = self.levels[side], self.prices[side]
+        if qty > 0:
+            if price not in levels:
+                insort(prices, price)
+            levels[price] = qty
+        elif levels.pop(price, None) is not None:
+            del prices[bisect_left(prices, price)]
+
+    def is_empty(self) -> bool:
+        return not self.prices[BUY] and not self.prices[SELL]
+
+    def best_price(self, side: str) -> Optional[int]:
+        prices = self.prices[side]
+        if not prices:
+            return None
+        return prices[-1] if side == BUY else prices[0]
+
+    def iter_levels(self, side: str) -> Iterator[Tuple[int, int]]:
+        """(цена, суммарный остаток) в порядке приоритета, как OrderBook.iter_levels."""
+        prices = reversed(self.prices[side]) if side == BUY else iter(self.prices[side])
+        for price in prices:
+            yield price, self.levels[side][price]
+
+    def top_levels(self, side: str, limit: int) -> List[Tuple[int, int]]:
+        return list(islice(self.iter_levels(side), limit))
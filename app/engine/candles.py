@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import text
+from ..database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые интервалы свечей и их длина в секундах
+INTERVALS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+# Как часто закрытые свечи пишутся в таблицу candles
+CANDLES_FLUSH_INTERVAL = float(os.getenv("CANDLES_FLUSH_INTERVAL", "1.0"))
+
+
+@dataclass
+class Candle:
+    ticker: str
+    period: str
+    start_time: datetime
+    open: int
+    high: int
+    low: int
+    close: int
+    # время первой и последней сделки: по ним open/close сливаются со строкой в БД
+    first_trade_at: datetime
+    last_trade_at: datetime
+    volume: int = 0
+    trades: int = 0
+
+    def add(self, price: int, qty: int, timestamp: datetime) -> None:
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.last_trade_at = timestamp
+        self.volume += qty
+        self.trades += 1
+
+    @property
+    def end_time(self) -> datetime:
+        return self.start_time + timedelta(seconds=INTERVALS[self.period])
+
+
+# Текущие (незакрытые) свечи и закрытые, которые ещё не записаны в БД
+OPEN_CANDLES: Dict[Tuple[str, str], Candle] = {}
+CLOSED_CANDLES: List[Candle] = []
+TASKS: List[asyncio.Task] = []
+
+# Свеча могла уже частично попасть в таблицу (с другого воркера или до рестарта) — сливаем.
+# open берётся от более ранней первой сделки, close — от более поздней последней, в каком
+# бы порядке ни пришли части. У строк без времени сделок (записаны до колонок) open остаётся.
+_UPSERT_CANDLE = text("""
+    INSERT INTO candles (
+        ticker, period, start_time, open, high, low, close, volume, trades, first_trade_at, last_trade_at
+    )
+    VALUES (
+        :ticker, :period, :start_time, :open, :high, :low, :close, :volume, :trades, :first_trade_at, :last_trade_at
+    )
+    ON CONFLICT (ticker, period, start_time) DO UPDATE
+    SET open = CASE WHEN excluded.first_trade_at < candles.first_trade_at
+                    THEN excluded.open ELSE candles.open END,
+        high = GREATEST(candles.high, excluded.high),
+        low = LEAST(candles.low, excluded.low),
+        close = CASE WHEN candles.last_trade_at IS NULL OR excluded.last_trade_at >= candles.last_trade_at
+                     THEN excluded.close ELSE candles.close END,
+        volume = candles.volume + excluded.volume,
+        trades = candles.trades + excluded.trades,
+        first_trade_at = LEAST(candles.first_trade_at, excluded.first_trade_at),
+        last_trade_at = GREATEST(candles.last_trade_at, excluded.last_trade_at)
+""")
+
+
+def bucket_start(timestamp: datetime, seconds: int) -> datetime:
+    return datetime.fromtimestamp(int(timestamp.timestamp()) // seconds * seconds, timezone.utc)
+
+
+def record_candle_trade(ticker: str, price: int, qty: int, timestamp: Optional[datetime] = None) -> None:
+    """Добавляет сделку во все интервалы; свеча прошлого периода закрывается и ждёт записи."""
+    timestamp = timestamp or datetime.now(timezone.utc)
+    for period, seconds in INTERVALS.items():
+        start_time = bucket_start(timestamp, seconds)
+        key = (ticker, period)
+        candle = OPEN_CANDLES.get(key)
+        if candle is not None and candle.start_time != start_time:
+            CLOSED_CANDLES.append(candle)
+            candle = None
+        if candle is None:
+            candle = OPEN_CANDLES[key] = Candle(
+                ticker, period, start_time, price, price, price, price, timestamp, timestamp
+            )
+        candle.add(price, qty, timestamp)
+
+
+def open_candle(ticker: str, period: str) -> Optional[Candle]:
+    return OPEN_CANDLES.get((ticker, period))
+
+
+def _close_expired(now: datetime) -> None:
+    for key, candle in list(OPEN_CANDLES.items()):
+        if candle.end_time <= now:
+            CLOSED_CANDLES.append(OPEN_CANDLES.pop(key))
+
+
+async def flush_candles(include_open: bool = False) -> None:
+    """
+    Пишет закрытые свечи одним executemany. include_open=True (остановка сервиса) —
+    дописывает и текущие: после рестарта период продолжится в той же строке.
+    """
+    _close_expired(datetime.now(timezone.utc))
+    closed = len(CLOSED_CANDLES)
+    batch = CLOSED_CANDLES[:closed]
+    if include_open:
+        batch.extend(OPEN_CANDLES.values())
+    if not batch:
+        return
+
+    async with AsyncSessionLocal() as db:
+        await db.execute(_UPSERT_CANDLE, [
+            {
+                "ticker": c.ticker, "period": c.period, "start_time": c.start_time,
+                "open": c.open, "high": c.high, "low": c.low, "close": c.close,
+                "volume": c.volume, "trades": c.trades,
+                "first_trade_at": c.first_trade_at, "last_trade_at": c.last_trade_at,
+            }
+            for c in batch
+        ])
+        await db.commit()
+
+    # за время записи могли закрыться новые свечи — убираем только записанные
+    del CLOSED_CANDLES[:closed]
+    if include_open:
+        OPEN_CANDLES.clear()
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(CANDLES_FLUSH_INTERVAL)
+        try:
+            await flush_candles()
+        except Exception:
+            logger.exception("candles flush failed")
+
+
+def start_candles() -> None:
+    TASKS.append(asyncio.create_task(_flush_loop(), name="candles-flush"))
+
+
+async def stop_candles() -> None:
+    for task in TASKS:
+        task.cancel()
+    await asyncio.gather(*TASKS, return_exceptions=True)
+    TASKS.clear()
+    await flush_candles(include_open=True)
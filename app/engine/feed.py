@@ -0,0 +1,114 @@
+import asyncio
+import os
+from typing import Dict, List, Optional, Set, Tuple
+from .book import BUY, SELL, BookView, OrderBook
+from .registry import add_book_listener, book_view, book_version, touched_levels
+
+# Сколько изменённых уровней может накопиться у медленного клиента; дальше — пересылка снапшота
+FEED_MAX_PENDING_LEVELS = int(os.getenv("FEED_MAX_PENDING_LEVELS", "1000"))
+# Через сколько секунд тишины клиенту уходит keep-alive
+FEED_HEARTBEAT = float(os.getenv("FEED_HEARTBEAT", "15"))
+
+LevelKey = Tuple[str, int]
+
+
+def book_snapshot(view: Optional[BookView]) -> Dict[str, list]:
+    if view is None:
+        return {"bids": [], "asks": []}
+    return {
+        "bids": [[price, qty] for price, qty in view.iter_levels(BUY)],
+        "asks": [[price, qty] for price, qty in view.iter_levels(SELL)],
+    }
+
+
+class Subscription:
+    """
+    Буфер одного клиента. Уровни хранятся абсолютными значениями, поэтому изменения
+    одного уровня, которые клиент не успел забрать, просто схлопываются в последнее.
+    """
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.pending: Dict[LevelKey, int] = {}
+        self.seq = 0
+        self.needs_snapshot = True
+        self.ready = asyncio.Event()
+        self.ready.set()
+
+    def push(self, seq: int, changes: Dict[LevelKey, int]) -> None:
+        self.seq = seq
+        if not self.needs_snapshot:
+            self.pending.update(changes)
+            if len(self.pending) > FEED_MAX_PENDING_LEVELS:
+                self.reset(seq)
+        self.ready.set()
+
+    def reset(self, seq: int) -> None:
+        self.seq = seq
+        self.pending.clear()
+        self.needs_snapshot = True
+        self.ready.set()
+
+    async def next_message(self) -> dict:
+        """Ждёт изменений и отдаёт одно сообщение: снапшот или накопленную дельту."""
+        await self.ready.wait()
+        self.ready.clear()
+
+        if self.needs_snapshot:
+            self.needs_snapshot = False
+            self.pending.clear()
+            return {"type": "snapshot", "seq": self.seq, **book_snapshot(book_view(self.ticker))}
+
+        changes, self.pending = self.pending, {}
+        return {
+            "type": "delta",
+            "seq": self.seq,
+            "bids": [[price, qty] for (side, price), qty in changes.items() if side == BUY],
+            "asks": [[price, qty] for (side, price), qty in changes.items() if side == SELL],
+        }
+
+
+SUBSCRIBERS: Dict[str, Set[Subscription]] = {}
+
+
+def subscribe(ticker: str) -> Subscription:
+    subscription = Subscription(ticker)
+    subscription.seq = book_version(ticker)
+    SUBSCRIBERS.setdefault(ticker, set()).add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription: Subscription) -> None:
+    subscribers = SUBSCRIBERS.get(subscription.ticker)
+    if subscribers is not None:
+        subscribers.discard(subscription)
+        if not subscribers:
+            del SUBSCRIBERS[subscription.ticker]
+
+
+def _touched_levels(book: OrderBook, events: List[tuple]) -> Dict[LevelKey, int]:
+    # представление уже обновлено реестром до рассылки
+    view = book_view(book.ticker)
+    return {
+        (side, price): view.levels[side].get(price, 0) if view is not None else 0
+        for side, price in touched_levels(events)
+    }
+
+
+def _on_book_change(book: OrderBook, events: Optional[List[tuple]]) -> None:
+    # версия стакана уже увеличена реестром перед рассылкой
+    seq = book_version(book.ticker)
+    subscribers = SUBSCRIBERS.get(book.ticker)
+    if not subscribers:
+        return
+    if events is None:
+        for subscription in subscribers:
+            subscription.reset(seq)
+        return
+    # уровни считаются один раз на публикацию, а не на каждого клиента
+    changes = _touched_levels(book, events)
+    for subscription in subscribers:
+        subscription.push(seq, changes)
+
+
+add_book_listener(_on_book_change)
@@ -0,0 +1,219 @@
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from uuid import UUID
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..models import Order, OrderStatus, OrderType
+from .book import BookView, OrderBook, RestingOrder, side_of
+
+logger = logging.getLogger(__name__)
+
+# memory — стакан держится в памяти процесса, sql — каждый матчинг читает встречные ордера из БД
+ORDERBOOK_ENGINE = os.getenv("ORDERBOOK_ENGINE", "memory")
+IN_MEMORY = ORDERBOOK_ENGINE == "memory"
+
+BOOKS: Dict[str, OrderBook] = {}
+# Опубликованные (закоммиченные) уровни стаканов — то, что отдаётся читателям
+VIEWS: Dict[str, BookView] = {}
+# Номер версии стакана: растёт на каждой опубликованной (закоммиченной) перемене
+BOOK_VERSIONS: Dict[str, int] = {}
+
+# Подписчики на закоммиченные изменения стакана: listener(book, events).
+# events=None — стакан перестроен целиком и его надо перечитать.
+BookListener = Callable[[OrderBook, Optional[List[tuple]]], None]
+LISTENERS: List[BookListener] = []
+
+
+def add_book_listener(listener: BookListener) -> None:
+    LISTENERS.append(listener)
+
+
+def book_view(ticker: str) -> Optional[BookView]:
+    return VIEWS.get(ticker)
+
+
+def _update_view(book: OrderBook, events: Optional[List[tuple]]) -> None:
+    if BOOKS.get(book.ticker) is not book:
+        # стакан удалён (drop_book)
+        VIEWS.pop(book.ticker, None)
+        return
+    view = VIEWS.get(book.ticker)
+    if events is None or view is None:
+        VIEWS[book.ticker] = BookView.of(book)
+        return
+    for side, price in touched_levels(events):
+        level = book.levels[side].get(price)
+        view.set_level(side, price, level.total_qty if level is not None else 0)
+
+
+def touched_levels(events: List[tuple]) -> Set[Tuple[str, int]]:
+    """Уровни (сторона, цена), которые задели события стакана."""
+    touched = set()
+    for event in events:
+        if event[0] == "A":
+            touched.add((event[1].direction, event[1].price))
+        else:
+            touched.add(event[-2:])
+    return touched
+
+
+def refresh_views() -> None:
+    """Публикует все стаканы целиком — после восстановления в обход _notify."""
+    VIEWS.clear()
+    for book in BOOKS.values():
+        VIEWS[book.ticker] = BookView.of(book)
+
+
+def book_version(ticker: str) -> int:
+    return BOOK_VERSIONS.get(ticker, 0)
+
+
+def touch_book(ticker: str) -> None:
+    """Сдвигает версию стакана без изменений в нём: инструмент создан или удалён."""
+    BOOK_VERSIONS[ticker] = book_version(ticker) + 1
+
+
+def publish_book(ticker: str) -> None:
+    """Вызывается после коммита: отдаёт накопленные изменения стакана подписчикам."""
+    if not IN_MEMORY:
+        # стакана в памяти нет, но этот процесс только что поменял ордера по тикеру
+        touch_book(ticker)
+        return
+    book = BOOKS.get(ticker)
+    if book is None or not book.events:
+        return
+    events, book.events = book.events, []
+    _notify(book, events)
+
+
+def _publish_reset(book: OrderBook) -> None:
+    book.events.clear()
+    _notify(book, None)
+
+
+def _notify(book: OrderBook, events: Optional[List[tuple]]) -> None:
+    touch_book(book.ticker)
+    # после коммита стакан совпадает с БД: переносим задетые уровни в опубликованное представление
+    _update_view(book, events)
+    # транзакция уже закоммичена: ошибка подписчика не должна долетать до обработчика заявки
+    for listener in LISTENERS:
+        try:
+            listener(book, events)
+        except Exception:
+            logger.exception("book listener failed", extra={"ticker": book.ticker})
+
+
+def get_book(ticker: str) -> OrderBook:
+    book = BOOKS.get(ticker)
+    if book is None:
+        book = BOOKS[ticker] = OrderBook(ticker)
+    return book
+
+
+def drop_book(ticker: str) -> None:
+    book = BOOKS.pop(ticker, None)
+    if book is not None:
+        book.clear()
+        _publish_reset(book)
+    else:
+        # стакана не было, но в кэше мог остаться пустой ответ по тикеру
+        touch_book(ticker)
+
+
+def to_resting(order: Order) -> RestingOrder:
+    return RestingOrder(
+        id=order.id,
+        user_id=order.user_id if isinstance(order.user_id, UUID) else UUID(str(order.user_id)),
+        direction=side_of(order.direction),
+        price=order.price,
+        qty=order.qty,
+        filled=order.filled or 0,
+    )
+
+
+def rest_order(order: Order) -> None:
+    """Ставит закоммиченный лимитный ордер в стакан, если у него остался объём."""
+    if not IN_MEMORY or order.price is None:
+        return
+    if side_of(order.status) not in (OrderStatus.NEW.value, OrderStatus.PARTIALLY_EXECUTED.value):
+        return
+    get_book(order.instrument_ticker).add(to_resting(order))
+
+
+def unrest_order(ticker: str, order_id: UUID) -> None:
+    if IN_MEMORY and ticker in BOOKS:
+        BOOKS[ticker].remove(order_id)
+
+
+def drop_user_orders(ticker: str, user_id: UUID) -> None:
+    """Снимает ордера пользователя со стакана тикера; вызывается из очереди актора."""
+    book = BOOKS.get(ticker)
+    if book is not None and book.remove_user(user_id):
+        publish_book(ticker)
+
+
+def _open_orders_stmt(ticker: Optional[str] = None):
+    stmt = (
+        select(
+            Order.id,
+            Order.user_id,
+            Order.instrument_ticker,
+            Order.direction,
+            Order.price,
+            Order.qty,
+            Order.filled,
+        )
+        .where(
+            Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]),
+            Order.type == OrderType.LIMIT,
+        )
+        .order_by(Order.timestamp)
+    )
+    if ticker is not None:
+        stmt = stmt.where(Order.instrument_ticker == ticker)
+    return stmt
+
+
+def _fill_books(rows) -> int:
+    count = 0
+    for id_, user_id, ticker, direction, price, qty, filled in rows:
+        get_book(ticker).add(RestingOrder(id_, user_id, side_of(direction), price, qty, filled or 0))
+        count += 1
+    return count
+
+
+async def load_books(db: AsyncSession) -> None:
+    """Строит стаканы по всем открытым лимитным ордерам при старте приложения."""
+    if not IN_MEMORY:
+        return
+    BOOKS.clear()
+    VIEWS.clear()
+    result = await db.stream(_open_orders_stmt())
+    count = 0
+    async for partition in result.partitions(1000):
+        count += _fill_books(partition)
+    for book in BOOKS.values():
+        _publish_reset(book)
+    logger.info("order books loaded", extra={"orders": count, "books": len(BOOKS)})
+
+
+async def reload_book(db: AsyncSession, ticker: str) -> None:
+    """
+    Перечитывает стакан инструмента из БД. Вызывается после отката,
+    когда состояние в памяти могло разойтись с закоммиченным.
+    """
+    if not IN_MEMORY:
+        return
+    book = get_book(ticker)
+    book.clear()
+    result = await db.execute(_open_orders_stmt(ticker))
+    _fill_books(result.all())
+    _publish_reset(book)
+
+
+async def rollback_book(db: AsyncSession, ticker: str) -> None:
+    """После отката транзакции: если стакан успел измениться, перечитывает его из БД."""
+    book = BOOKS.get(ticker)
+    if book is not None and book.events:
+        await reload_book(db, ticker)
@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, IO, Iterable, List, Optional, Tuple
+from uuid import UUID
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..models import OrderStatus, OrderType
+from ..database import AsyncSessionLocal
+from .actor import MatchingQueueFull, submit
+from .book import BUY, SELL, OrderBook, RestingOrder, side_of
+from .registry import BOOKS, IN_MEMORY, add_book_listener, drop_book, get_book, load_books, refresh_views, reload_book
+
+logger = logging.getLogger(__name__)
+
+# Каталог для снапшотов стаканов и журналов; пусто — снапшоты выключены
+SNAPSHOT_DIR = os.getenv("ORDERBOOK_SNAPSHOT_DIR", "")
+SNAPSHOT_INTERVAL = float(os.getenv("ORDERBOOK_SNAPSHOT_INTERVAL", "60"))
+SNAPSHOTS_ENABLED = IN_MEMORY and bool(SNAPSHOT_DIR)
+
+SNAPSHOT_MAGIC = b"OBS2"
+# После магии — водяной знак: orders.change_seq, до которого снапшот вместе с журналом
+# отражает все изменения ордеров тикера. -1 — неизвестен, тикер на старте перечитывается.
+WATERMARK = struct.Struct("<q")
+UNKNOWN_WATERMARK = -1
+
+# A: id, user_id, direction, price, qty, filled; F: id, filled; D: id
+ADD = struct.Struct("<c16s16sBqqq")
+FILL = struct.Struct("<c16sq")
+DELETE = struct.Struct("<c16s")
+RECORDS = {b"A": ADD, b"F": FILL, b"D": DELETE}
+
+JOURNALS: Dict[str, IO[bytes]] = {}
+TASKS: List[asyncio.Task] = []
+# Вся работа с файлами — в одном потоке вне event loop: записи журнала, снапшоты
+# и удаления ложатся на диск ровно в том порядке, в каком стаканы их породили
+FILES = ThreadPoolExecutor(max_workers=1, thread_name_prefix="orderbook-files")
+
+
+def _path(ticker: str, suffix: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"{ticker}.{suffix}")
+
+
+def _encode_add(order: RestingOrder) -> bytes:
+    return ADD.pack(
+        b"A",
+        order.id.bytes,
+        order.user_id.bytes,
+        0 if order.direction == BUY else 1,
+        order.price,
+        order.qty,
+        order.filled,
+    )
+
+
+def _encode(event: tuple) -> bytes:
+    kind = event[0]
+    if kind == "A":
+        return _encode_add(event[1])
+    if kind == "F":
+        return FILL.pack(b"F", event[1].bytes, event[2])
+    return DELETE.pack(b"D", event[1].bytes)
+
+
+def _decode(data: bytes):
+    """Разбирает поток записей; обрезанный хвост (запись не успела дописаться) отбрасывается."""
+    offset = 0
+    while offset < len(data):
+        record = RECORDS.get(data[offset:offset + 1])
+        if record is None or offset + record.size > len(data):
+            return
+        yield record.unpack_from(data, offset)
+        offset += record.size
+
+
+def _apply(book: OrderBook, record: tuple) -> None:
+    kind = record[0]
+    if kind == b"A":
+        _, id_, user_id, direction, price, qty, filled = record
+        book.add(RestingOrder(UUID(bytes=id_), UUID(bytes=user_id), BUY if direction == 0 else SELL, price, qty, filled))
+    elif kind == b"F":
+        book.set_filled(UUID(bytes=record[1]), record[2])
+    else:
+        book.remove(UUID(bytes=record[1]))
+
+
+def _journal(ticker: str) -> IO[bytes]:
+    journal = JOURNALS.get(ticker)
+    if journal is None:
+        journal = JOURNALS[ticker] = open(_path(ticker, "journal"), "ab")
+    return journal
+
+
+def _append_journal(ticker: str, data: bytes) -> None:
+    # события публикуются после коммита в БД; fsync делает их переживающими падение машины
+    journal = _journal(ticker)
+    journal.write(data)
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def _encode_snapshot(book: OrderBook) -> bytes:
+    """Стакан целиком, в порядке приоритета, чтобы сохранить очередь внутри уровней."""
+    return b"".join(
+        _encode_add(order)
+        for side in (BUY, SELL)
+        for level in book.iter_levels(side)
+        for order in level.orders
+    )
+
+
+def _parse_snapshot(data: bytes) -> Tuple[int, bytes]:
+    """(водяной знак, записи); снапшот старого формата или битый — знак неизвестен."""
+    header = len(SNAPSHOT_MAGIC) + WATERMARK.size
+    if not data.startswith(SNAPSHOT_MAGIC) or len(data) < header:
+        return UNKNOWN_WATERMARK, b""
+    return WATERMARK.unpack_from(data, len(SNAPSHOT_MAGIC))[0], data[header:]
+
+
+def _write_snapshot_file(ticker: str, data: bytes, watermark: Optional[int]) -> None:
+    """
+    Подменяет снапшот атомарно и обнуляет журнал. watermark=None — стакан перестроен
+    без знания знака (перечитан из БД после отката): остаётся прежний знак, он не
+    новее состояния, и сверка на старте лишь захватит больше ордеров.
+    """
+    if watermark is None:
+        watermark, _ = _parse_snapshot(_read(_path(ticker, "snap")))
+    tmp_path = _path(ticker, "snap.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + WATERMARK.pack(watermark))
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, _path(ticker, "snap"))
+
+    journal = JOURNALS.pop(ticker, None)
+    if journal is not None:
+        journal.close()
+    open(_path(ticker, "journal"), "wb").close()
+
+
+def _remove_files(ticker: str) -> None:
+    journal = JOURNALS.pop(ticker, None)
+    if journal is not None:
+        journal.close()
+    for suffix in ("snap", "journal"):
+        try:
+            os.remove(_path(ticker, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def _in_files_thread(fn, *args) -> asyncio.Future:
+    return asyncio.get_running_loop().run_in_executor(FILES, fn, *args)
+
+
+def _log_failure(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("order book file write failed", exc_info=future.exception())
+
+
+def _schedule(fn, *args) -> None:
+    _in_files_thread(fn, *args).add_done_callback(_log_failure)
+
+
+def _on_book_change(book: OrderBook, events: Optional[List[tuple]]) -> None:
+    # байты собираются здесь, пока стакан в этом состоянии; на диск их пишет поток FILES
+    if events is None:
+        # сброс удалённого инструмента (drop_book) — файлы больше не нужны
+        if BOOKS.get(book.ticker) is not book:
+            _schedule(_remove_files, book.ticker)
+        else:
+            _schedule(_write_snapshot_file, book.ticker, _encode_snapshot(book), None)
+        return
+    _schedule(_append_journal, book.ticker, b"".join(_encode(event) for event in events))
+
+
+def _read(path: str) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return b""
+
+
+def _restore_book(ticker: str) -> int:
+    """Снапшот и хвост журнала в стакан; возвращает водяной знак снапшота."""
+    book = get_book(ticker)
+    watermark, records = _parse_snapshot(_read(_path(ticker, "snap")))
+    for record in _decode(records):
+        _apply(book, record)
+    for record in _decode(_read(_path(ticker, "journal"))):
+        _apply(book, record)
+    book.events.clear()
+    return watermark
+
+
+# Инструменты и есть ли по ним открытые лимитные ордера — по одной пробе частичного индекса
+_INSTRUMENTS_WITH_BOOKS = text("""
+    SELECT i.ticker, EXISTS (
+        SELECT 1 FROM orders AS o
+        WHERE o.instrument_ticker = i.ticker
+          AND o.status IN ('NEW', 'PARTIALLY_EXECUTED')
+          AND o.type = 'LIMIT'
+    )
+    FROM instruments AS i
+""")
+
+# Текущий водяной знак тикера: обратный проход по idx_orders_change_seq до первой строки
+_WATERMARKS = text("""
+    SELECT t.ticker, COALESCE((
+        SELECT max(o.change_seq) FROM orders AS o WHERE o.instrument_ticker = t.ticker
+    ), 0)
+    FROM unnest(CAST(:tickers AS varchar[])) AS t(ticker)
+""")
+
+# Ордера, изменённые после водяного знака своего тикера
+_CHANGED_ORDERS = text("""
+    SELECT o.id, o.user_id, o.instrument_ticker, o.direction, o.price, o.qty, o.filled,
+           o.status, o.type, o.change_seq
+    FROM unnest(CAST(:tickers AS varchar[]), CAST(:watermarks AS bigint[])) AS w(ticker, watermark)
+    JOIN orders AS o ON o.instrument_ticker = w.ticker AND o.change_seq > w.watermark
+    ORDER BY o.change_seq
+""")
+
+_OPEN_STATUSES = (OrderStatus.NEW.value, OrderStatus.PARTIALLY_EXECUTED.value)
+
+
+async def fetch_watermarks(db: AsyncSession, tickers: Iterable[str]) -> Dict[str, int]:
+    tickers = list(tickers)
+    if not tickers:
+        return {}
+    return dict((await db.execute(_WATERMARKS, {"tickers": tickers})).all())
+
+
+async def _catch_up(db: AsyncSession, watermarks: Dict[str, int]) -> Dict[str, int]:
+    """
+    Доводит восстановленные стаканы до БД по ордерам, изменённым после водяного знака:
+    журнал дописывается после коммита, и при падении между ними стакан может отстать.
+    Возвращает новые знаки тикеров, в которых нашлись изменения.
+    """
+    if not watermarks:
+        return {}
+    result = await db.execute(_CHANGED_ORDERS, {
+        "tickers": list(watermarks),
+        "watermarks": list(watermarks.values()),
+    })
+    advanced: Dict[str, int] = {}
+    for id_, user_id, ticker, direction, price, qty, filled, status, type_, change_seq in result:
+        book = get_book(ticker)
+        filled = filled or 0
+        if side_of(status) in _OPEN_STATUSES and side_of(type_) == OrderType.LIMIT.value and qty > filled:
+            if id_ in book.orders:
+                book.set_filled(id_, filled)
+            else:
+                book.add(RestingOrder(id_, user_id, side_of(direction), price, qty, filled))
+        else:
+            book.remove(id_)
+        advanced[ticker] = change_seq
+    return advanced
+
+
+async def restore_books(db: AsyncSession) -> None:
+    """
+    Поднимает стаканы из последних снапшотов и хвоста журнала и сверяет с БД только
+    ордера, изменённые после водяного знака снапшота. Тикеры без снапшота (или со
+    снапшотом без знака) перечитываются из orders целиком, стаканы удалённых
+    инструментов выбрасываются. Без ORDERBOOK_SNAPSHOT_DIR — обычный load_books.
+    """
+    if not SNAPSHOTS_ENABLED:
+        await load_books(db)
+        return
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    add_book_listener(_on_book_change)
+    BOOKS.clear()
+    tickers = {name.rsplit(".", 1)[0] for name in os.listdir(SNAPSHOT_DIR) if name.endswith((".snap", ".journal"))}
+    restored = {ticker: _restore_book(ticker) for ticker in tickers}
+
+    instruments = dict((await db.execute(_INSTRUMENTS_WITH_BOOKS)).all())
+    for ticker in tickers - set(instruments):
+        drop_book(ticker)
+
+    known = {t: w for t, w in restored.items() if t in instruments and w != UNKNOWN_WATERMARK}
+    reload = [t for t, has_orders in instruments.items() if has_orders and t not in known]
+    # знак берётся до чтения: всё, что не старше его, перечитанный стакан уже отражает
+    watermarks = await fetch_watermarks(db, reload)
+    for ticker in reload:
+        await reload_book(db, ticker)
+
+    watermarks.update(await _catch_up(db, known))
+    refresh_views()
+    for ticker, watermark in watermarks.items():
+        book = BOOKS.get(ticker)
+        if book is not None:
+            book.events.clear()
+            _schedule(_write_snapshot_file, ticker, _encode_snapshot(book), watermark)
+    logger.info("order books restored", extra={
+        "books": len(BOOKS), "reloaded": reload, "caught_up": sorted(set(watermarks) - set(reload)),
+    })
+
+
+async def _snapshot_job(db: AsyncSession, ticker: str) -> Optional[asyncio.Future]:
+    # в очереди актора только снимается состояние; запись и fsync идут уже без неё.
+    # Незакоммиченных изменений по тикеру здесь нет, поэтому знак точно соответствует стакану.
+    book = BOOKS.get(ticker)
+    if book is None:
+        return None
+    watermark = (await fetch_watermarks(db, [ticker]))[ticker]
+    return _in_files_thread(_write_snapshot_file, ticker, _encode_snapshot(book), watermark)
+
+
+async def _snapshot_loop() -> None:
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        for ticker in list(BOOKS):
+            try:
+                # через очередь актора: снапшот не застанет незакоммиченный матчинг
+                written = await submit(ticker, _snapshot_job, ticker)
+                if written is not None:
+                    await written
+            except MatchingQueueFull:
+                logger.warning("snapshot skipped: matching queue is full", extra={"ticker": ticker})
+            except Exception:
+                logger.exception("snapshot failed", extra={"ticker": ticker})
+
+
+def start_snapshots() -> None:
+    if SNAPSHOTS_ENABLED:
+        TASKS.append(asyncio.create_task(_snapshot_loop(), name="orderbook-snapshots"))
+
+
+async def stop_snapshots() -> None:
+    """Останавливает таймер и пишет финальные снапшоты, чтобы следующий старт не читал журнал."""
+    for task in TASKS:
+        task.cancel()
+    await asyncio.gather(*TASKS, return_exceptions=True)
+    TASKS.clear()
+    if not SNAPSHOTS_ENABLED:
+        return
+    # прерванный остановкой матчинг мог оставить неопубликованные изменения: такие стаканы
+    # не пишем, их снапшот и журнал на диске уже соответствуют закоммиченному
+    books = {ticker: book for ticker, book in BOOKS.items() if not book.events}
+    async with AsyncSessionLocal() as db:
+        watermarks = await fetch_watermarks(db, books)
+    # поток FILES пишет по порядку: снапшоты лягут после всех уже поставленных записей журнала
+    await asyncio.gather(*(
+        _in_files_thread(_write_snapshot_file, ticker, _encode_snapshot(book), watermarks[ticker])
+        for ticker, book in books.items()
+    ))
@@ -0,0 +1,71 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from .auction import is_auction
+from .book import BUY, SELL
+from .registry import book_view
+
+
+@dataclass
+class LastTrade:
+    price: int
+    qty: int
+    timestamp: datetime
+
+
+# Последняя сделка по каждому тикеру; пишется после коммита расчёта
+LAST_TRADES: Dict[str, LastTrade] = {}
+
+# По одной пробе idx_transactions_ticker_time на инструмент (в каждой партиции), без
+# чтения всей таблицы сделок, как было бы с DISTINCT ON
+_LAST_TRADES = text("""
+    SELECT i.ticker, t.price, t.qty, t.timestamp
+    FROM instruments AS i
+    CROSS JOIN LATERAL (
+        SELECT price, qty, timestamp
+        FROM transactions
+        WHERE ticker = i.ticker
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1
+    ) AS t
+""")
+
+
+def record_last_trade(ticker: str, price: int, qty: int, timestamp: Optional[datetime] = None) -> None:
+    LAST_TRADES[ticker] = LastTrade(price, qty, timestamp or datetime.now(timezone.utc))
+
+
+def forget_ticker(ticker: str) -> None:
+    LAST_TRADES.pop(ticker, None)
+
+
+def ticker_snapshot(ticker: str) -> Optional[dict]:
+    """Верх стакана и последняя сделка из памяти. None — по тикеру ничего не известно."""
+    view = book_view(ticker)
+    last = LAST_TRADES.get(ticker)
+    if view is None and last is None:
+        return None
+    best_bid = view.best_price(BUY) if view is not None else None
+    best_ask = view.best_price(SELL) if view is not None else None
+    spread = best_ask - best_bid if best_bid is not None and best_ask is not None else None
+    if spread is not None and spread <= 0 and is_auction(ticker):
+        # стакан аукциона между раундами пересечён — отрицательного спреда не отдаём
+        spread = None
+    return {
+        "ticker": ticker,
+        "best_bid": best_bid,
+        "best_ask": best_ask,
+        "spread": spread,
+        "last_price": last.price if last else None,
+        "last_qty": last.qty if last else None,
+        "last_timestamp": last.timestamp if last else None,
+    }
+
+
+async def load_last_trades(db: AsyncSession) -> None:
+    """Последняя сделка по каждому инструменту одним запросом."""
+    result = await db.execute(_LAST_TRADES)
+    for ticker, price, qty, timestamp in result:
+        record_last_trade(ticker, price, qty, timestamp)
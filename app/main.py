@@ -3,13 +3,28 @@ from .endpoints.order import router as order_router
 from .endpoints.balance import router as balance_router
 from .endpoints.admin import router as admin_router
 from .endpoints.public import router as public_router
+from .database import AsyncSessionLocal
+from .engine import (
+    load_last_trades,
+    restore_books,
+    start_auctions,
+    start_candles,
+    start_snapshots,
+    stop_actors,
+    stop_auctions,
+    stop_candles,
+    stop_snapshots,
+)
+from .crud.orders import process_auction
+from .maintenance import start_maintenance, stop_maintenance
+from . import metrics
 import json
 import logging
 import sys
 import time
 import uuid
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.exceptions import HTTPException
 
 logging.getLogger("uvicorn").handlers.clear()
@@ -82,6 +97,27 @@ if not root_logger.handlers:
 app = FastAPI(debug=True)
 
 
+@app.on_event("startup")
+async def load_order_books():
+    async with AsyncSessionLocal() as session:
+        await restore_books(session)
+        await load_last_trades(session)
+    start_auctions(process_auction)
+    start_snapshots()
+    start_candles()
+    start_maintenance()
+
+
+@app.on_event("shutdown")
+async def stop_matching():
+    await stop_maintenance()
+    await stop_auctions()
+    await stop_actors()
+    # после остановки акторов стаканы уже не меняются
+    await stop_snapshots()
+    await stop_candles()
+
+
 @app.middleware("http")
 async def access_log_middleware(request: Request, call_next):
     request_id = str(uuid.uuid4())
@@ -164,3 +200,13 @@ app.include_router(reports_router, prefix="/api/v1")
 @app.get("/")
 def read_root():
     return {"message": "API работает!"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    # счётчики процесса в текстовом формате Prometheus
+    lines = []
+    for name, value in sorted(metrics.snapshot().items()):
+        lines.append(f"# TYPE exchange_{name}_total counter")
+        lines.append(f"exchange_{name}_total {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import os
+from datetime import date, datetime, timezone
+from typing import List
+from sqlalchemy import text
+from .crud.ledger import BALANCE_LEDGER, BALANCE_LEDGER_COMPACT_BATCH, compact_ledger
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# На сколько месяцев вперёд держать готовые партиции transactions
+TRANSACTIONS_PARTITIONS_AHEAD = int(os.getenv("TRANSACTIONS_PARTITIONS_AHEAD", "2"))
+PARTITIONS_CHECK_INTERVAL = float(os.getenv("PARTITIONS_CHECK_INTERVAL", "86400"))
+# Как часто журнал балансов сворачивается в balances
+BALANCE_LEDGER_COMPACT_INTERVAL = float(os.getenv("BALANCE_LEDGER_COMPACT_INTERVAL", "1.0"))
+
+TASKS: List[asyncio.Task] = []
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+async def ensure_transaction_partitions() -> None:
+    """
+    Создаёт партиции transactions на текущий и TRANSACTIONS_PARTITIONS_AHEAD следующих месяцев.
+    Каждый месяц — отдельная транзакция: ошибка на одном не откатывает уже созданные,
+    а блокировки DEFAULT-партиции держатся не дольше одного месяца.
+    """
+    today = datetime.now(timezone.utc).date().replace(day=1)
+    for i in range(TRANSACTIONS_PARTITIONS_AHEAD + 1):
+        month = add_months(today, i)
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(text("SELECT create_transactions_partition(:month)"), {"month": month})
+                await db.commit()
+        except Exception:
+            logger.exception(f"transactions partition for {month:%Y-%m} failed")
+
+
+async def _partitions_loop() -> None:
+    while True:
+        try:
+            await ensure_transaction_partitions()
+        except Exception:
+            logger.exception("transactions partitions check failed")
+        await asyncio.sleep(PARTITIONS_CHECK_INTERVAL)
+
+
+async def _ledger_loop() -> None:
+    while True:
+        await asyncio.sleep(BALANCE_LEDGER_COMPACT_INTERVAL)
+        try:
+            # пока журнал не вычерпан полностью, сворачиваем без паузы
+            async with AsyncSessionLocal() as db:
+                while await compact_ledger(db) >= BALANCE_LEDGER_COMPACT_BATCH:
+                    pass
+        except Exception:
+            logger.exception("balance ledger compaction failed")
+
+
+def start_maintenance() -> None:
+    TASKS.append(asyncio.create_task(_partitions_loop(), name="transactions-partitions"))
+    if BALANCE_LEDGER:
+        TASKS.append(asyncio.create_task(_ledger_loop(), name="balance-ledger-compaction"))
+
+
+async def stop_maintenance() -> None:
+    for task in TASKS:
+        task.cancel()
+    await asyncio.gather(*TASKS, return_exceptions=True)
+    TASKS.clear()
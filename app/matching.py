@@ -1,171 +1,227 @@
-from . import models
-from sqlalchemy import and_, select
+import os
+from typing import Optional, Tuple
+from sqlalchemy import and_, func, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
-from .crud.balances import apply_trade
-from .crud.transactions import create_transaction
-from .schemas import Direction
-from .models import Order,  OrderStatus,OrderType,OrderDirection
-
-async def execute_limit_order(session: AsyncSession, order: Order) -> None:
-    print(f"Opposite side: {order.direction}")
-    opposite_side = Direction.SELL if order.direction == Direction.BUY else Direction.BUY
-    print(f"Opposite side: {order.direction}")
-    print(f"Opposite side: {opposite_side}")
-    stmt = (
-        select(Order)
-        .where(
-            and_(
-                Order.instrument_ticker == order.instrument_ticker,
-                Order.direction == opposite_side,
-                Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]),
-                Order.price <= order.price if order.direction == Direction.BUY else Order.price >= order.price,
-            )
-        )
+from .crud.settlement import Settlement, StagedTrade
+from .engine import IN_MEMORY, BUY, SELL, Fill, RestingOrder, get_book, side_of
+from .models import Order, OrderStatus, OrderType, OrderDirection, PriceLevel
+
+
+# Сколько встречных ордеров за раз читается из БД в режиме sql
+COUNTER_ORDERS_CHUNK = int(os.getenv("COUNTER_ORDERS_CHUNK", "50"))
+
+
+def counter_orders_stmt(ticker: str, direction, limit_price: Optional[int], chunk: int, after=None):
+    """
+    Одна порция встречных лимитных ордеров в порядке цена-время.
+    after — ключ (price, timestamp, id) последней строки предыдущей порции.
+    """
+    is_buy = side_of(direction) == BUY
+    opposite_side = OrderDirection.SELL if is_buy else OrderDirection.BUY
+    conditions = [
+        Order.instrument_ticker == ticker,
+        Order.direction == opposite_side,
+        Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]),
+        Order.type == OrderType.LIMIT,
+    ]
+    if limit_price is not None:
+        conditions.append(Order.price <= limit_price if is_buy else Order.price >= limit_price)
+    if after is not None:
+        price, timestamp, id_ = after
+        conditions.append(or_(
+            Order.price > price if is_buy else Order.price < price,
+            and_(Order.price == price, Order.timestamp > timestamp),
+            and_(Order.price == price, Order.timestamp == timestamp, Order.id > id_),
+        ))
+
+    return (
+        select(Order.id, Order.user_id, Order.price, Order.qty, Order.filled, Order.timestamp)
+        .where(and_(*conditions))
         .order_by(
-            # Для BUY: сначала самые дешевые ордера (цена по возрастанию)
-            Order.price.asc() if order.direction == Direction.BUY else 
-            # Для SELL: сначала самые дорогие ордера (цена по убыванию)
-            Order.price.desc(),
+            # Для BUY: сначала самые дешевые ордера, для SELL — самые дорогие
+            Order.price.asc() if is_buy else Order.price.desc(),
             # Затем по времени для одинаковых цен
-            Order.timestamp
+            Order.timestamp,
+            Order.id,
         )
+        .limit(chunk)
     )
 
-    result = await session.execute(stmt)
-    matching_orders = result.scalars().all()
 
-    if not matching_orders:
-        return
+async def stream_counter_orders(
+    session: AsyncSession,
+    ticker: str,
+    direction,
+    limit_price: Optional[int],
+    max_rows: int,
+):
+    """
+    Встречные лимитные ордера в порядке цена-время, порциями по COUNTER_ORDERS_CHUNK
+    с keyset-пагинацией по (price, timestamp, id). Следующая порция читается только
+    если вызывающий код продолжил итерацию, так что память и время зависят от объёма
+    исполнения, а не от глубины стакана.
+    """
+    opposite = SELL if side_of(direction) == BUY else BUY
+    # каждый ордер даёт хотя бы единицу объёма, больше max_rows строк не понадобится
+    chunk = max(1, min(COUNTER_ORDERS_CHUNK, max_rows))
+
+    after = None
+    while True:
+        stmt = counter_orders_stmt(ticker, direction, limit_price, chunk, after)
+        rows = (await session.execute(stmt)).all()
+        for id_, user_id, price, qty, filled, timestamp in rows:
+            yield RestingOrder(id_, user_id, opposite, price, qty, filled or 0)
+
+        if len(rows) < chunk:
+            return
+        last = rows[-1]
+        after = (last.price, last.timestamp, last.id)
 
+
+async def market_depth(session: AsyncSession, ticker: str, direction, qty: int) -> Tuple[int, int]:
+    """
+    Предпроверка рыночного ордера: сколько объёма (не больше qty) есть на противоположной
+    стороне и точная стоимость его выкупа по уровням. Ордера как объекты не создаются:
+    в режиме memory считается по агрегатам стакана, в режиме sql — одним запросом по price_levels.
+    """
+    if IN_MEMORY:
+        return get_book(ticker).depth_for(direction, qty)
+
+    is_buy = side_of(direction) == BUY
+    # уровни уже агрегированы в price_levels, по ордерам проходить не нужно
+    levels = (
+        select(PriceLevel.price, PriceLevel.total_qty.label("level_qty"))
+        .where(
+            PriceLevel.ticker == ticker,
+            PriceLevel.direction == (OrderDirection.SELL if is_buy else OrderDirection.BUY),
+            PriceLevel.total_qty > 0,
+        )
+        .subquery("levels")
+    )
+    # объём на всех более выгодных уровнях
+    qty_before = func.sum(levels.c.level_qty).over(
+        order_by=levels.c.price.asc() if is_buy else levels.c.price.desc()
+    ) - levels.c.level_qty
+    cumulative = select(levels.c.price, levels.c.level_qty, qty_before.label("qty_before")).subquery("cumulative")
+
+    take = func.least(cumulative.c.level_qty, qty - cumulative.c.qty_before)
+    result = await session.execute(
+        select(
+            func.coalesce(func.sum(take), 0),
+            func.coalesce(func.sum(take * cumulative.c.price), 0),
+        )
+        .where(cumulative.c.qty_before < qty)
+    )
+    available, cost = result.one()
+    return int(available), int(cost)
+
+
+async def _iter_fills(session: AsyncSession, order: Order):
+    """
+    Отдаёт сделки входящего ордера в порядке приоритета цена-время.
+    У Fill.order поле filled уже учитывает эту сделку.
+    """
     remaining_qty = order.qty - order.filled
 
-    for counter_order in matching_orders:
+    if IN_MEMORY:
+        for fill in get_book(order.instrument_ticker).match(order.direction, remaining_qty, order.price):
+            yield fill
+        return
+
+    counter_orders = stream_counter_orders(
+        session, order.instrument_ticker, order.direction, order.price, remaining_qty
+    )
+    async for counter_order in counter_orders:
+        trade_qty = min(remaining_qty, counter_order.remaining)
+        counter_order.filled += trade_qty
+        remaining_qty -= trade_qty
+        yield Fill(counter_order, trade_qty, counter_order.price)
         if remaining_qty == 0:
             break
+    await counter_orders.aclose()
 
-        available_qty = counter_order.qty - counter_order.filled
-        trade_qty = min(remaining_qty, available_qty)
-        trade_price = counter_order.price
 
-        if order.direction == Direction.BUY:
-                buyer_id = order.user_id
-                seller_id = counter_order.user_id
-        else:
-            buyer_id = counter_order.user_id
-            seller_id = order.user_id
-
-        initial_locked_price = order.price if order.direction == Direction.BUY else counter_order.price
-        print("Заблокированная часть:", initial_locked_price)
-        print("Направиление ордера:", order.direction)
-        await apply_trade(
-            session,
-            buyer_id,
-            seller_id,
-            order.instrument_ticker,
-            trade_price,
-            trade_qty,
-            initial_locked_price
-        )
+async def _match(session: AsyncSession, order: Order) -> Settlement:
+    is_buy = side_of(order.direction) == BUY
+    settlement = Settlement(order.instrument_ticker)
 
-        await execute_trade(session, order, counter_order, trade_qty, trade_price)
+    async for fill in _iter_fills(session, order):
+        counter_order = fill.order
 
-        counter_order.filled += trade_qty
-        if counter_order.filled == counter_order.qty:
-            counter_order.status = OrderStatus.EXECUTED
+        if is_buy:
+            trade = StagedTrade(
+                buy_order_id=order.id,
+                sell_order_id=counter_order.id,
+                buyer_id=order.user_id,
+                seller_id=counter_order.user_id,
+                qty=fill.qty,
+                price=fill.price,
+                # У рыночной заявки своей цены нет — средства блокировались по цене встречного ордера
+                buyer_locked_price=order.price if order.price is not None else counter_order.price,
+            )
         else:
-            counter_order.status = OrderStatus.PARTIALLY_EXECUTED
+            trade = StagedTrade(
+                buy_order_id=counter_order.id,
+                sell_order_id=order.id,
+                buyer_id=counter_order.user_id,
+                seller_id=order.user_id,
+                qty=fill.qty,
+                price=fill.price,
+                buyer_locked_price=counter_order.price,
+            )
 
-        remaining_qty -= trade_qty
+        settlement.add_trade(trade)
+        settlement.fill_order(counter_order, fill.qty)
+        order.filled += fill.qty
+
+    return settlement
+
+
+def _reserve(settlement: Settlement, order: Order, amount: int) -> None:
+    if amount:
+        ticker = "RUB" if side_of(order.direction) == BUY else order.instrument_ticker
+        settlement.reserve(order.user_id, ticker, amount)
+
+
+async def execute_limit_order(session: AsyncSession, order: Order, match: bool = True, reserve: int = 0) -> Settlement:
+    """
+    match=False — инструмент в режиме аукциона: ордер только встаёт в стакан.
+    reserve — сколько заблокировать под ордер (RUB при покупке, актив при продаже);
+    проверяется и ставится в том же захвате строк balances, что и расчёт по сделкам.
+    """
+    settlement = await _match(session, order) if match else Settlement(order.instrument_ticker)
+    _reserve(settlement, order, reserve)
 
-    order.filled = order.qty - remaining_qty
     if order.filled == order.qty:
         order.status = OrderStatus.EXECUTED
-    else:
+    elif order.filled > 0:
         order.status = OrderStatus.PARTIALLY_EXECUTED
 
-    await session.flush()
-
+    if order.filled < order.qty:
+        settlement.change_level(side_of(order.direction), order.price, order.qty - order.filled, 1)
 
-async def execute_market_order(session: AsyncSession, order: Order) -> None:
-    try:
-        print(f"Order: {order.type, order.direction}")
-        opposite_side = OrderDirection.SELL if order.direction == OrderDirection.BUY else OrderDirection.BUY
-        print(f"Opposite side: {order.direction}")
-        print(f"Opposite side: {opposite_side}")
-        stmt = (
-            select(Order)
-            .where(
-                and_(
-                    Order.instrument_ticker == order.instrument_ticker,
-                    Order.direction == opposite_side,
-                    Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIALLY_EXECUTED]),
-                    Order.price.isnot(None),
-                    Order.type == OrderType.LIMIT,
-                )
-            )
-            .order_by(
-                # Для MARKET BUY: берем самые дешевые предложения (цена по возрастанию)
-                Order.price.asc() if order.direction == OrderDirection.BUY else 
-                # Для MARKET SELL: берем самые дорогие предложения (цена по убыванию)
-                Order.price.desc(),
-                # Затем по времени для одинаковых цен
-                Order.timestamp.asc()
-            )
-        )
-        result = await session.execute(stmt)
-        matching_orders = result.scalars().all()
+    await settlement.flush(session)
+    await session.flush()
+    return settlement
 
-        if not matching_orders:
-            return
 
+def _market_spent(settlement: Settlement, order: Order) -> int:
+    """Сколько из блокировки рыночного ордера сняли его сделки."""
+    if side_of(order.direction) == BUY:
+        return sum(t.buyer_locked_price * t.qty for t in settlement.trades if t.buy_order_id == order.id)
+    return order.filled
 
-        remaining_qty = order.qty - order.filled
-
-        for counter_order in matching_orders:
-
-            print(f"Order: {counter_order.type, counter_order.direction}")
-            if remaining_qty == 0:
-                break
-            if counter_order.price is None:
-                    continue
-            
-            available_qty = counter_order.qty - counter_order.filled
-            trade_qty = min(remaining_qty, available_qty)
-            trade_price = counter_order.price
-            print(f"Order: {order.type, order.direction}")
-            if order.direction == OrderDirection.BUY:
-                buyer_id = order.user_id
-                seller_id = counter_order.user_id
-            else:
-                buyer_id = counter_order.user_id
-                seller_id = order.user_id
-
-            try:
-                
-                initial_locked_price = counter_order.price if counter_order.price is not None else trade_price
-
-                await apply_trade(
-                    session,
-                    buyer_id,
-                    seller_id,
-                    order.instrument_ticker,
-                    trade_price,
-                    trade_qty,
-                    initial_locked_price
-                )
-                await execute_trade(session, order, counter_order, trade_qty, trade_price)
-            except Exception as e:
-                raise  # ошибка поднимется наверх и откатит всю транзакцию
-
-            counter_order.filled += trade_qty
-            counter_order.status = (
-                OrderStatus.EXECUTED if counter_order.filled == counter_order.qty
-                else OrderStatus.PARTIALLY_EXECUTED
-            )
 
-            remaining_qty -= trade_qty
+async def execute_market_order(session: AsyncSession, order: Order, reserve: int = 0) -> Settlement:
+    try:
+        settlement = await _match(session, order)
+        if order.filled < order.qty:
+            # стакан мог поредеть после оценки глубины: остаток рыночного ордера не встаёт
+            # в стакан, поэтому блокируется ровно то, что сняли сделки, а остаток reserve — нет
+            reserve = _market_spent(settlement, order)
+        _reserve(settlement, order, reserve)
+        await settlement.flush(session)
 
-        order.filled = order.qty - remaining_qty
         if order.filled == order.qty:
             order.status = OrderStatus.EXECUTED
         elif order.filled > 0:
@@ -174,20 +230,37 @@ async def execute_market_order(session: AsyncSession, order: Order) -> None:
             order.status = OrderStatus.CANCELLED
 
         await session.flush()
+        return settlement
 
-    except Exception as e:
+    except Exception:
         order.status = OrderStatus.CANCELLED
         raise
-    finally:
-        if order.filled == 0 and order.status == OrderStatus.NEW:
-            order.status = OrderStatus.CANCELLED
 
 
-async def execute_trade(
-    session: AsyncSession,
-    order1: models.Order,
-    order2: models.Order,
-    qty: float,
-    price: float,
-):
-    await create_transaction(order1, order2, qty, price, session)
+async def execute_auction(session: AsyncSession, ticker: str) -> Optional[Settlement]:
+    """
+    Один раунд периодического аукциона: накопленный стакан исполняется по единой цене,
+    максимизирующей объём, все сделки рассчитываются одним Settlement.
+    """
+    book = get_book(ticker)
+    clearing = book.clearing_price()
+    if clearing is None:
+        return None
+
+    price, volume = clearing
+    settlement = Settlement(ticker)
+    for buy_order, sell_order, qty in book.uncross(price, volume):
+        settlement.add_trade(StagedTrade(
+            buy_order_id=buy_order.id,
+            sell_order_id=sell_order.id,
+            buyer_id=buy_order.user_id,
+            seller_id=sell_order.user_id,
+            qty=qty,
+            price=price,
+            buyer_locked_price=buy_order.price,
+        ))
+        settlement.fill_order(buy_order, qty)
+        settlement.fill_order(sell_order, qty)
+
+    await settlement.flush(session)
+    return settlement
@@ -0,0 +1,17 @@
+from collections import Counter
+from typing import Dict
+
+# Счётчики процесса (ретраи дедлоков и т.п.), читаются бенчмарком и мониторингом
+COUNTERS: Counter = Counter()
+
+
+def inc(name: str, value: int = 1) -> None:
+    COUNTERS[name] += value
+
+
+def snapshot() -> Dict[str, int]:
+    return dict(COUNTERS)
+
+
+def reset() -> None:
+    COUNTERS.clear()
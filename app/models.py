@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, ForeignKey
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from sqlalchemy import Enum as SqlEnum
@@ -30,6 +30,8 @@ class Balance(Base):
     instrument_ticker = Column(String, ForeignKey("instruments.ticker"), primary_key=True)
     amount = Column(Integer, default=0)
     locked = Column(Integer, default=0)
+    # растёт при каждом изменении строки; по нему сверяется оптимистичный режим (BALANCE_OPTIMISTIC)
+    version = Column(Integer, nullable=False, default=0, server_default=text("0"))
     user = relationship("User")
 
 class OrderType(enum.Enum):
@@ -58,11 +60,14 @@ class Order(Base):
     status = Column(SqlEnum(OrderStatus, name="order_status_enum"), nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     filled = Column(Integer, default=0)
+    # номер последнего изменения: DEFAULT и триггер на UPDATE берут его из orders_change_seq
+    change_seq = Column(BigInteger, server_default=text("nextval('orders_change_seq')"))
 
     user = relationship("User")
 
 
 class Transaction(Base):
+    # В БД партиционирована по месяцам timestamp, первичный ключ там (id, timestamp)
     __tablename__ = "transactions"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -72,4 +77,47 @@ class Transaction(Base):
     timestamp = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
 
     buy_order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id"), nullable=True)
-    sell_order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id"), nullable=True)
\ No newline at end of file
+    sell_order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id"), nullable=True)
+
+
+class PriceLevel(Base):
+    """Агрегат стакана по уровню цены; меняется в той же транзакции, что и ордера."""
+    __tablename__ = "price_levels"
+
+    ticker = Column(String(10), ForeignKey("instruments.ticker", ondelete="CASCADE"), primary_key=True)
+    direction = Column(SqlEnum(OrderDirection, name="order_direction_enum"), primary_key=True)
+    price = Column(Integer, primary_key=True)
+    total_qty = Column(Integer, nullable=False, default=0)
+    order_count = Column(Integer, nullable=False, default=0)
+
+
+class Candle(Base):
+    """OHLCV-свеча; пишется при закрытии периода (app.engine.candles)."""
+    __tablename__ = "candles"
+
+    ticker = Column(String(10), ForeignKey("instruments.ticker", ondelete="CASCADE"), primary_key=True)
+    period = Column(String(3), primary_key=True)
+    start_time = Column(TIMESTAMP(timezone=True), primary_key=True)
+    open = Column(Integer, nullable=False)
+    high = Column(Integer, nullable=False)
+    low = Column(Integer, nullable=False)
+    close = Column(Integer, nullable=False)
+    volume = Column(Integer, nullable=False, default=0)
+    trades = Column(Integer, nullable=False, default=0)
+    first_trade_at = Column(TIMESTAMP(timezone=True))
+    last_trade_at = Column(TIMESTAMP(timezone=True))
+
+
+class BalanceLedger(Base):
+    """
+    Несвёрнутые изменения балансов (режим BALANCE_LEDGER): сделки только дописывают сюда строки,
+    фоновая задача периодически сворачивает их в balances.
+    """
+    __tablename__ = "balance_ledger"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    instrument_ticker = Column(String(10), ForeignKey("instruments.ticker", ondelete="CASCADE"), nullable=False)
+    amount = Column(Integer, nullable=False, default=0)
+    locked = Column(Integer, nullable=False, default=0)
+    timestamp = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, UUID4, StrictInt, Field, model_validator
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 from enum import Enum
 from datetime import datetime
 
@@ -140,6 +140,27 @@ class WithdrawRequest(BaseModel):
     ticker: str
     amount: int = Field(..., gt=0)
 
+class BalanceOperation(str, Enum):
+    DEPOSIT = "DEPOSIT"
+    WITHDRAW = "WITHDRAW"
+
+class BalanceBatchItem(BaseModel):
+    operation: BalanceOperation
+    user_id: UUID4
+    ticker: str
+    amount: int = Field(..., gt=0)
+
+class BalanceBatchRequest(BaseModel):
+    operations: List[BalanceBatchItem] = Field(..., min_length=1, max_length=10000)
+
+class BalanceBatchResult(BaseModel):
+    success: bool
+    error: Optional[str] = None
+
+class BalanceBatchResponse(BaseModel):
+    # результаты в том же порядке, что и операции в запросе
+    results: List[BalanceBatchResult]
+
 class Transaction(BaseModel):
     ticker: str
     amount: int
@@ -160,6 +181,27 @@ class L2OrderBook(BaseModel):
     bid_levels: List[Level]  
     ask_levels: List[Level] 
 
+class Candle(BaseModel):
+    start_time: datetime
+    open: int
+    high: int
+    low: int
+    close: int
+    volume: int
+    trades: int
+
+    class Config:
+        from_attributes = True
+
+class TickerInfo(BaseModel):
+    ticker: str
+    best_bid: Optional[int] = None
+    best_ask: Optional[int] = None
+    spread: Optional[int] = None
+    last_price: Optional[int] = None
+    last_qty: Optional[int] = None
+    last_timestamp: Optional[datetime] = None
+
 class ValidationError:
     loc: List[Union[str, int]]
     msg: str
@@ -25,6 +25,7 @@ CREATE TABLE IF NOT EXISTS balances (
     instrument_ticker VARCHAR(10),
     amount INTEGER DEFAULT 0,
     locked INTEGER DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0,
     PRIMARY KEY (user_id, instrument_ticker),
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
     FOREIGN KEY (instrument_ticker) REFERENCES instruments(ticker) ON DELETE CASCADE
@@ -43,22 +44,134 @@ CREATE TABLE IF NOT EXISTS orders (
     filled INTEGER DEFAULT 0
 );
 
+-- Номер последнего изменения ордера: по нему снапшот стакана на старте сверяется только с более поздними
+CREATE SEQUENCE IF NOT EXISTS orders_change_seq;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS change_seq BIGINT DEFAULT nextval('orders_change_seq');
+
+CREATE OR REPLACE FUNCTION orders_bump_change_seq() RETURNS trigger AS $$
+BEGIN
+    NEW.change_seq := nextval('orders_change_seq');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS orders_change_seq ON orders;
+CREATE TRIGGER orders_change_seq BEFORE UPDATE ON orders
+FOR EACH ROW EXECUTE FUNCTION orders_bump_change_seq();
+
+-- Сделки партиционированы по месяцам (UTC); партиции вперёд создаёт приложение
 CREATE TABLE IF NOT EXISTS transactions (
-    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
     ticker VARCHAR(10) NOT NULL,
     qty INTEGER NOT NULL,
     price INTEGER NOT NULL,
     timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     buy_order_id UUID REFERENCES orders(id) ON DELETE SET NULL,
-    sell_order_id UUID REFERENCES orders(id) ON DELETE SET NULL
+    sell_order_id UUID REFERENCES orders(id) ON DELETE SET NULL,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE OR REPLACE FUNCTION create_transactions_partition(month_start date) RETURNS void AS $$
+DECLARE
+    month timestamp := date_trunc('month', month_start::timestamp);
+    partition_name text := 'transactions_' || to_char(month, 'YYYY_MM');
+    range_from timestamptz := month AT TIME ZONE 'UTC';
+    range_to timestamptz := (month + interval '1 month') AT TIME ZONE 'UTC';
+    in_default boolean := false;
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    IF to_regclass('transactions_default') IS NOT NULL THEN
+        LOCK TABLE transactions_default IN EXCLUSIVE MODE;
+        EXECUTE 'SELECT EXISTS (SELECT 1 FROM transactions_default WHERE timestamp >= $1 AND timestamp < $2)'
+        INTO in_default USING range_from, range_to;
+    END IF;
+
+    IF NOT in_default THEN
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+            partition_name, range_from, range_to
+        );
+        RETURN;
+    END IF;
+
+    -- строки месяца уже лежат в DEFAULT: партиция создаётся отдельно, строки переносятся, затем она присоединяется
+    EXECUTE format('CREATE TABLE %I (LIKE transactions INCLUDING DEFAULTS)', partition_name);
+    EXECUTE format(
+        'WITH moved AS ('
+        '    DELETE FROM transactions_default WHERE timestamp >= $1 AND timestamp < $2 RETURNING *'
+        ') INSERT INTO %I SELECT * FROM moved',
+        partition_name
+    ) USING range_from, range_to;
+    EXECUTE format(
+        'ALTER TABLE transactions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, range_from, range_to
+    );
+END
+$$ LANGUAGE plpgsql;
+
+SELECT create_transactions_partition(month::date)
+FROM generate_series(
+    date_trunc('month', now() AT TIME ZONE 'UTC'),
+    date_trunc('month', now() AT TIME ZONE 'UTC') + interval '2 months',
+    interval '1 month'
+) AS month;
+
+CREATE TABLE IF NOT EXISTS transactions_default PARTITION OF transactions DEFAULT;
+
+CREATE TABLE IF NOT EXISTS price_levels (
+    ticker VARCHAR(10) REFERENCES instruments(ticker) ON DELETE CASCADE,
+    direction order_direction_enum NOT NULL,
+    price INTEGER NOT NULL,
+    total_qty INTEGER NOT NULL DEFAULT 0,
+    order_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (ticker, direction, price)
+);
+
+CREATE TABLE IF NOT EXISTS candles (
+    ticker VARCHAR(10) REFERENCES instruments(ticker) ON DELETE CASCADE,
+    period VARCHAR(3) NOT NULL,
+    start_time TIMESTAMPTZ NOT NULL,
+    open INTEGER NOT NULL,
+    high INTEGER NOT NULL,
+    low INTEGER NOT NULL,
+    close INTEGER NOT NULL,
+    volume INTEGER NOT NULL DEFAULT 0,
+    trades INTEGER NOT NULL DEFAULT 0,
+    first_trade_at TIMESTAMPTZ,
+    last_trade_at TIMESTAMPTZ,
+    PRIMARY KEY (ticker, period, start_time)
+);
+
+-- Несвёрнутые изменения балансов (BALANCE_LEDGER=1), только INSERT
+CREATE TABLE IF NOT EXISTS balance_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    instrument_ticker VARCHAR(10) NOT NULL REFERENCES instruments(ticker) ON DELETE CASCADE,
+    amount INTEGER NOT NULL DEFAULT 0,
+    locked INTEGER NOT NULL DEFAULT 0,
+    timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
 CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id);
 CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
 CREATE INDEX IF NOT EXISTS idx_orders_ticker ON orders(instrument_ticker);
 CREATE INDEX IF NOT EXISTS idx_orders_price ON orders(price);
-CREATE INDEX IF NOT EXISTS idx_transactions_ticker ON transactions(ticker);
+CREATE INDEX IF NOT EXISTS idx_orders_change_seq ON orders(instrument_ticker, change_seq);
+CREATE INDEX IF NOT EXISTS idx_orders_open_book ON orders(instrument_ticker, direction, price, timestamp, id)
+    INCLUDE (qty, filled, user_id)
+    WHERE status IN ('NEW', 'PARTIALLY_EXECUTED') AND type = 'LIMIT';
+CREATE INDEX IF NOT EXISTS idx_orders_open_bids ON orders(instrument_ticker, price DESC, timestamp, id)
+    INCLUDE (qty, filled, user_id)
+    WHERE status IN ('NEW', 'PARTIALLY_EXECUTED') AND type = 'LIMIT' AND direction = 'BUY';
+CREATE INDEX IF NOT EXISTS idx_orders_open_by_time ON orders(timestamp)
+    WHERE status IN ('NEW', 'PARTIALLY_EXECUTED') AND type = 'LIMIT';
+CREATE INDEX IF NOT EXISTS idx_transactions_ticker_time ON transactions(ticker, timestamp DESC, id DESC)
+    INCLUDE (qty, price);
 CREATE INDEX IF NOT EXISTS idx_transactions_timestamp ON transactions(timestamp);
+CREATE INDEX IF NOT EXISTS idx_balance_ledger_key ON balance_ledger(user_id, instrument_ticker)
+    INCLUDE (amount, locked);
 
 INSERT INTO instruments (ticker, name) VALUES
     ('USD', 'US Dollar'),
@@ -0,0 +1,95 @@
+"""
+Архивация старых месячных партиций transactions.
+
+Партиции старше окна хранения (--retention-months, по умолчанию
+TRANSACTIONS_RETENTION_MONTHS или 12) выгружаются через COPY в сжатые CSV
+{out-dir}/transactions_YYYY_MM.csv.gz, после чего отсоединяются и удаляются.
+Выгрузка, отсоединение и удаление идут в одной транзакции под блокировкой партиции.
+Файл пишется во временный и переименовывается только после успешной выгрузки,
+партиция удаляется только после этого.
+
+    python -m scripts.archive_transactions --out-dir /var/backups/transactions --dry-run
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import re
+from datetime import date, datetime, timezone
+import asyncpg
+from app.database import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER
+from app.maintenance import add_months
+
+PARTITION_NAME = re.compile(r"^transactions_(\d{4})_(\d{2})$")
+
+LIST_PARTITIONS = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relname = 'transactions'
+    ORDER BY c.relname
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--retention-months",
+        type=int,
+        default=int(os.getenv("TRANSACTIONS_RETENTION_MONTHS", "12")),
+        help="сколько последних месяцев оставить в БД",
+    )
+    parser.add_argument("--out-dir", default=os.getenv("TRANSACTIONS_ARCHIVE_DIR", "archive"))
+    parser.add_argument("--dry-run", action="store_true", help="только показать, что будет заархивировано")
+    return parser.parse_args()
+
+
+def cold_partitions(names, retention_months: int):
+    cutoff = add_months(datetime.now(timezone.utc).date().replace(day=1), -retention_months)
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match and date(int(match[1]), int(match[2]), 1) < cutoff:
+            yield name
+
+
+async def archive_partition(conn: asyncpg.Connection, name: str, out_dir: str) -> int:
+    path = os.path.join(out_dir, f"{name}.csv.gz")
+    tmp_path = path + ".tmp"
+
+    # выгрузка и отсоединение — одна транзакция: с момента блокировки до DROP
+    # в партицию не может попасть строка, которой нет в архиве
+    async with conn.transaction():
+        await conn.execute(f'LOCK TABLE "{name}" IN SHARE MODE')
+        rows = await conn.fetchval(f'SELECT count(*) FROM "{name}"')
+        with gzip.open(tmp_path, "wb") as f:
+            await conn.copy_from_table(name, output=f, format="csv", header=True)
+        os.replace(tmp_path, path)
+
+        await conn.execute(f'ALTER TABLE transactions DETACH PARTITION "{name}"')
+        await conn.execute(f'DROP TABLE "{name}"')
+    return rows
+
+
+async def main():
+    args = parse_args()
+    conn = await asyncpg.connect(host=DB_HOST, port=int(DB_PORT or 5432), user=DB_USER, password=DB_PASS, database=DB_NAME)
+    try:
+        names = [row["relname"] for row in await conn.fetch(LIST_PARTITIONS)]
+        cold = list(cold_partitions(names, args.retention_months))
+        if not cold:
+            print("nothing to archive")
+            return
+        os.makedirs(args.out_dir, exist_ok=True)
+        for name in cold:
+            if args.dry_run:
+                print(f"would archive {name}")
+                continue
+            rows = await archive_partition(conn, name, args.out_dir)
+            print(f"archived {name}: {rows} rows")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,204 @@
+"""
+Нагрузочный бенчмарк матчинга на синтетическом потоке заявок.
+
+Гонит воспроизводимый (по --seed) поток лимитных и рыночных заявок через
+process_limit_order / process_market_order так же, как это делает API: через
+очередь актора инструмента. Нужен локальный Postgres из .env (DB_*).
+
+    python -m scripts.bench_matching --orders 5000 --users 50 --concurrency 16 --depth 500
+
+Печатает orders/sec, fills/sec, p50/p99/p999 латентности, ретраи дедлоков
+и число запросов к БД на заявку. Тестовые инструменты, пользователи и их
+ордера удаляются после прогона (если не указан --keep).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Dict, List
+from uuid import uuid4
+from fastapi import HTTPException
+from sqlalchemy import delete, event, func, select
+from sqlalchemy.dialects.postgresql import insert
+from app import metrics
+from app.crud.orders import process_limit_order, process_market_order
+from app.database import AsyncSessionLocal, engine
+from app.engine import MatchingQueueFull, load_books, stop_actors, submit
+from app.models import Balance, Instrument, Transaction, User
+from app.schemas import Direction, LimitOrderBody, MarketOrderBody
+
+RUB = "RUB"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=2000, help="сколько заявок отправить")
+    parser.add_argument("--users", type=int, default=20, help="сколько торгующих пользователей")
+    parser.add_argument("--tickers", type=int, default=1, help="сколько инструментов (акторов) параллельно")
+    parser.add_argument("--concurrency", type=int, default=8, help="сколько клиентов шлют заявки одновременно")
+    parser.add_argument("--market-ratio", type=float, default=0.2, help="доля рыночных заявок")
+    parser.add_argument("--mid", type=int, default=1000, help="средняя цена")
+    parser.add_argument("--spread", type=float, default=10.0, help="ст. отклонение цены лимитных заявок")
+    parser.add_argument("--max-qty", type=int, default=10, help="максимальный объём заявки")
+    parser.add_argument("--depth", type=int, default=0, help="сколько непересекающихся ордеров поставить в стакан заранее")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--prefix", default="BN", help="префикс тикеров бенчмарка")
+    parser.add_argument("--json", action="store_true", help="вывести результат одной строкой JSON")
+    parser.add_argument("--keep", action="store_true", help="не удалять тестовые данные")
+    return parser.parse_args()
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def generate_flow(args, tickers: List[str], user_ids: List[str]):
+    """Синтетический поток (job, body, user_id); при одном seed всегда одинаковый."""
+    rng = random.Random(args.seed)
+    flow = []
+    for _ in range(args.orders):
+        ticker = rng.choice(tickers)
+        direction = rng.choice((Direction.BUY, Direction.SELL))
+        qty = rng.randint(1, args.max_qty)
+        user_id = rng.choice(user_ids)
+        if rng.random() < args.market_ratio:
+            flow.append((process_market_order, MarketOrderBody(direction=direction, ticker=ticker, qty=qty), user_id))
+        else:
+            price = max(1, round(rng.gauss(args.mid, args.spread)))
+            flow.append((process_limit_order, LimitOrderBody(direction=direction, ticker=ticker, qty=qty, price=price), user_id))
+    return flow
+
+
+def generate_depth(args, tickers: List[str], user_ids: List[str]):
+    """Начальный стакан: биды ниже mid, аски выше, друг с другом не сводятся."""
+    rng = random.Random(args.seed + 1)
+    flow = []
+    for _ in range(args.depth):
+        ticker = rng.choice(tickers)
+        direction = rng.choice((Direction.BUY, Direction.SELL))
+        offset = 1 + abs(round(rng.gauss(0, args.spread * 3)))
+        price = max(1, args.mid - offset) if direction == Direction.BUY else args.mid + offset
+        body = LimitOrderBody(direction=direction, ticker=ticker, qty=rng.randint(1, args.max_qty), price=price)
+        flow.append((process_limit_order, body, rng.choice(user_ids)))
+    return flow
+
+
+async def setup(args, run_id: str):
+    tickers = [f"{args.prefix}{i}" for i in range(args.tickers)]
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            insert(Instrument)
+            .values([{"ticker": t, "name": "benchmark"} for t in [RUB, *tickers]])
+            .on_conflict_do_nothing()
+        )
+        users = [User(name="benchmark", api_key=f"bench-{run_id}-{i}") for i in range(args.users)]
+        db.add_all(users)
+        await db.flush()
+        # денег и бумаг с запасом: бенчмарк меряет матчинг, а не отказы по балансу
+        db.add_all(
+            Balance(user_id=user.id, instrument_ticker=ticker, amount=amount, locked=0)
+            for user in users
+            for ticker, amount in [(RUB, 10 ** 9), *((t, 10 ** 6) for t in tickers)]
+        )
+        await db.commit()
+        await load_books(db)
+    return tickers, [str(user.id) for user in users]
+
+
+async def cleanup(tickers: List[str], user_ids: List[str]):
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(Transaction).where(Transaction.ticker.in_(tickers)))
+        # ордера и балансы удалятся каскадом
+        await db.execute(delete(Instrument).where(Instrument.ticker.in_(tickers)))
+        await db.execute(delete(User).where(User.id.in_(user_ids)))
+        await db.commit()
+
+
+async def count_fills(tickers: List[str]) -> int:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(func.count()).where(Transaction.ticker.in_(tickers)))
+        return result.scalar_one()
+
+
+async def run_flow(flow, concurrency: int, stats: Dict[str, int], latencies: List[float]):
+    queue = iter(flow)
+
+    async def client():
+        for job, body, user_id in queue:
+            started = time.perf_counter()
+            try:
+                await submit(body.ticker, job, body, user_id)
+                stats["accepted"] += 1
+            except MatchingQueueFull:
+                stats["queue_full"] += 1
+            except (ValueError, HTTPException):
+                stats["rejected"] += 1
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+async def main():
+    args = parse_args()
+    # echo=True из database.py на нагрузке меряет скорее логирование, чем БД
+    engine.sync_engine.echo = False
+
+    round_trips = 0
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count_round_trip(conn, cursor, statement, parameters, context, executemany):
+        nonlocal round_trips
+        round_trips += 1
+
+    run_id = uuid4().hex[:8]
+    tickers, user_ids = await setup(args, run_id)
+    try:
+        warmup = {"accepted": 0, "rejected": 0, "queue_full": 0}
+        await run_flow(generate_depth(args, tickers, user_ids), args.concurrency, warmup, [])
+        fills_before = await count_fills(tickers)
+
+        metrics.reset()
+        round_trips = 0
+        stats = {"accepted": 0, "rejected": 0, "queue_full": 0}
+        latencies: List[float] = []
+        started = time.perf_counter()
+        await run_flow(generate_flow(args, tickers, user_ids), args.concurrency, stats, latencies)
+        elapsed = time.perf_counter() - started
+        queries = round_trips
+
+        fills = await count_fills(tickers) - fills_before
+    finally:
+        await stop_actors()
+        if not args.keep:
+            await cleanup(tickers, user_ids)
+        await engine.dispose()
+
+    report = {
+        "orders": args.orders,
+        "elapsed_s": round(elapsed, 3),
+        "orders_per_s": round(args.orders / elapsed, 1),
+        "fills": fills,
+        "fills_per_s": round(fills / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "p999_ms": round(percentile(latencies, 0.999) * 1000, 2),
+        "db_round_trips_per_order": round(queries / args.orders, 2),
+        # повторы и отказы считает run_with_retries по SQLSTATE, а не по тексту ошибки
+        "deadlock_retries": metrics.COUNTERS["deadlock_retries"],
+        "serialization_retries": metrics.COUNTERS["serialization_retries"],
+        "retries_exhausted": metrics.COUNTERS["balance_retries_exhausted"],
+        **stats,
+    }
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key:>26}: {value}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
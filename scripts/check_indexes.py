@@ -0,0 +1,123 @@
+"""
+Проверка планов горячих запросов по открытым ордерам.
+
+Для каждого запроса выполняется EXPLAIN (FORMAT JSON) на базе из .env (DB_*) и
+проверяется, что он читает нужный индекс (для матчинга — index-only scan по
+idx_orders_open_book, для бидов — по idx_orders_open_bids) и что над сканом нет
+Sort/Incremental Sort: порядок выдачи должен давать сам индекс. Seq/bitmap scan на время проверки запрещены, чтобы на маленькой
+тестовой базе планировщик не уходил в полный проход и проверялась именно пригодность
+индекса. Код возврата 1, если хоть один запрос не прошёл.
+
+    python -m scripts.check_indexes
+"""
+import asyncio
+import json
+import sys
+from datetime import datetime, timezone
+from uuid import UUID
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from app.crud.price_levels import price_levels_stmt
+from app.database import AsyncSessionLocal, engine
+from app.matching import counter_orders_stmt
+from app.models import OrderDirection
+
+TICKER = "AAPL"
+SORT_NODES = {"Sort", "Incremental Sort"}
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def iter_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from iter_nodes(child)
+
+
+# (название, запрос, ожидаемые типы узлов, индекс)
+CHECKS = [
+    (
+        "matching: встречные для лимитной покупки",
+        counter_orders_stmt(TICKER, OrderDirection.BUY, 1000, 50),
+        {"Index Only Scan"},
+        "idx_orders_open_book",
+    ),
+    (
+        "matching: встречные для рыночной продажи",
+        counter_orders_stmt(TICKER, OrderDirection.SELL, None, 50),
+        {"Index Only Scan"},
+        "idx_orders_open_bids",
+    ),
+    (
+        "matching: следующая порция бидов (keyset)",
+        counter_orders_stmt(
+            TICKER, OrderDirection.SELL, 900, 50,
+            after=(1000, datetime(2024, 1, 1, tzinfo=timezone.utc), UUID(int=0)),
+        ),
+        {"Index Only Scan"},
+        "idx_orders_open_bids",
+    ),
+    (
+        "matching: следующая порция (keyset)",
+        counter_orders_stmt(
+            TICKER, OrderDirection.BUY, 1000, 50,
+            after=(990, datetime(2024, 1, 1, tzinfo=timezone.utc), UUID(int=0)),
+        ),
+        {"Index Only Scan"},
+        "idx_orders_open_book",
+    ),
+    (
+        "orderbook: биды из price_levels",
+        price_levels_stmt(TICKER, OrderDirection.BUY, 10),
+        {"Index Scan"},
+        "price_levels_pkey",
+    ),
+    (
+        "orderbook: аски из price_levels",
+        price_levels_stmt(TICKER, OrderDirection.SELL, 10),
+        {"Index Scan"},
+        "price_levels_pkey",
+    ),
+]
+
+
+async def main() -> int:
+    engine.sync_engine.echo = False
+    failed = 0
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(text("SET LOCAL enable_seqscan = off"))
+            await db.execute(text("SET LOCAL enable_bitmapscan = off"))
+            for name, stmt, node_types, index in CHECKS:
+                raw = (await db.execute(Explain(stmt))).scalar_one()
+                plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+                scans = [
+                    (node["Node Type"], node.get("Index Name"))
+                    for node in iter_nodes(plan)
+                    if "Scan" in node["Node Type"]
+                ]
+                sorts = [node["Node Type"] for node in iter_nodes(plan) if node["Node Type"] in SORT_NODES]
+                ok = not sorts and any(
+                    node_type in node_types and index_name == index for node_type, index_name in scans
+                )
+                failed += not ok
+                print(f"{'OK  ' if ok else 'FAIL'} {name}: {scans + sorts}")
+            await db.rollback()
+    finally:
+        await engine.dispose()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
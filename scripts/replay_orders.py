@@ -0,0 +1,141 @@
+"""
+Офлайн-прогон истории ордеров через матчинг.
+
+Читает orders в порядке (timestamp, id) в read-only транзакции и заново сводит их
+на отдельных стаканах в памяти (app.engine.book), не трогая ни БД, ни стаканы
+работающего сервиса. На выходе — JSON lines: сделки и итог по каждому ордеру.
+Вывод детерминирован, два прогона (например, до и после правки движка) сравниваются diff'ом.
+Время обработки ордеров в него не входит: оно пишется в отдельный файл --timings,
+сводка латентности — в stderr.
+
+    python -m scripts.replay_orders --ticker AAPL --since 2024-01-01 --out replay.jsonl --timings timings.jsonl
+
+Когда ордер был отменён, в таблице не записано, поэтому отменённые лимитные
+ордера либо стоят в стакане до конца прогона, либо (--skip-cancelled) пропускаются.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+from sqlalchemy import select, text
+from app.database import AsyncSessionLocal, engine
+from app.engine.book import BUY, OrderBook, RestingOrder, side_of
+from app.models import Order, OrderStatus, OrderType
+from .bench_matching import percentile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ticker", action="append", help="только эти инструменты (можно несколько раз)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="ордера не раньше этого момента")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="ордера раньше этого момента")
+    parser.add_argument("--skip-cancelled", action="store_true", help="не прогонять отменённые ордера")
+    parser.add_argument("--out", help="файл для JSON lines (по умолчанию stdout)")
+    parser.add_argument("--timings", help="файл для времени обработки каждого ордера (JSON lines)")
+    return parser.parse_args()
+
+
+def orders_stmt(args):
+    stmt = select(
+        Order.id, Order.user_id, Order.instrument_ticker, Order.direction,
+        Order.type, Order.price, Order.qty, Order.status,
+    ).order_by(Order.timestamp, Order.id)
+    if args.ticker:
+        stmt = stmt.where(Order.instrument_ticker.in_(args.ticker))
+    if args.since:
+        stmt = stmt.where(Order.timestamp >= args.since)
+    if args.until:
+        stmt = stmt.where(Order.timestamp < args.until)
+    if args.skip_cancelled:
+        stmt = stmt.where(Order.status != OrderStatus.CANCELLED)
+    return stmt
+
+
+def replay_order(books: Dict[str, OrderBook], row, out, timings_out=None) -> Tuple[int, float]:
+    """Сводит один ордер так же, как execute_limit_order / execute_market_order в режиме memory."""
+    book = books.get(row.instrument_ticker)
+    if book is None:
+        book = books[row.instrument_ticker] = OrderBook(row.instrument_ticker)
+
+    is_limit = row.type == OrderType.LIMIT
+    started = time.perf_counter()
+    if is_limit:
+        fills = book.match(row.direction, row.qty, row.price)
+    elif book.depth_for(row.direction, row.qty)[0] < row.qty:
+        # как в process_market_order: без полного покрытия рыночная заявка отклоняется
+        fills = []
+    else:
+        fills = book.match(row.direction, row.qty)
+    filled = sum(fill.qty for fill in fills)
+    if is_limit and filled < row.qty:
+        book.add(RestingOrder(row.id, row.user_id, side_of(row.direction), row.price, row.qty, filled))
+    # события стакана в прогоне никому не нужны
+    book.events.clear()
+    elapsed = time.perf_counter() - started
+
+    is_buy = side_of(row.direction) == BUY
+    for fill in fills:
+        out.write(json.dumps({
+            "kind": "trade",
+            "ticker": row.instrument_ticker,
+            "buy_order_id": str(row.id if is_buy else fill.order.id),
+            "sell_order_id": str(fill.order.id if is_buy else row.id),
+            "qty": fill.qty,
+            "price": fill.price,
+        }) + "\n")
+    out.write(json.dumps({
+        "kind": "order",
+        "order_id": str(row.id),
+        "ticker": row.instrument_ticker,
+        "type": row.type.value,
+        "filled": filled,
+        "fills": len(fills),
+    }) + "\n")
+    if timings_out is not None:
+        timings_out.write(json.dumps({"order_id": str(row.id), "elapsed_us": round(elapsed * 1e6, 1)}) + "\n")
+    return len(fills), elapsed
+
+
+async def main():
+    args = parse_args()
+    engine.sync_engine.echo = False
+    out = open(args.out, "w") if args.out else sys.stdout
+    timings_out = open(args.timings, "w") if args.timings else None
+
+    books: Dict[str, OrderBook] = {}
+    timings: List[float] = []
+    trades = 0
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(text("SET TRANSACTION READ ONLY"))
+            result = await db.stream(orders_stmt(args))
+            async for partition in result.partitions(1000):
+                for row in partition:
+                    fills, elapsed = replay_order(books, row, out, timings_out)
+                    trades += fills
+                    timings.append(elapsed)
+            await db.rollback()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if timings_out is not None:
+            timings_out.close()
+        await engine.dispose()
+
+    total = sum(timings)
+    print(json.dumps({
+        "orders": len(timings),
+        "trades": trades,
+        "resting_after": sum(len(book.orders) for book in books.values()),
+        "matching_s": round(total, 3),
+        "p50_us": round(percentile(timings, 0.50) * 1e6, 1),
+        "p99_us": round(percentile(timings, 0.99) * 1e6, 1),
+        "p999_us": round(percentile(timings, 0.999) * 1e6, 1),
+    }), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())